@@ -7,13 +7,22 @@ Bluelet: easy concurrency without all the messy parallelism.
 """
 import socket
 import select
+import os
 import sys
 import types
 import errno
+import stat
 import traceback
 import time
+import math
+import heapq
+import itertools
 import collections
 import weakref
+import threading
+import signal
+import struct
+import pickle
 
 
 # A little bit of "six" (Python 2/3 compatibility): cope with PEP 3109 syntax
@@ -23,21 +32,43 @@ PY3 = sys.version_info[0] == 3
 if PY3:
     def _reraise(typ, exc, tb):
         raise exc.with_traceback(tb)
+
+    # Makes events awaitable from native (async def) coroutines. The
+    # event is passed up to the scheduler, and whatever the scheduler
+    # sends back is the result of the await.
+    exec("""
+def _await(event):
+    return (yield event)
+""")
 else:
     exec("""
 def _reraise(typ, exc, tb):
     raise typ, exc, tb
 """)
 
+# Threads can be made from generators or, where available, native
+# coroutines.
+_COROUTINE_TYPES = (types.GeneratorType,)
+if hasattr(types, 'CoroutineType'):
+    _COROUTINE_TYPES += (types.CoroutineType,)
+
+
+# Timing uses a monotonic clock where available so that adjustments to
+# the system clock don't shorten or stretch sleeps.
+
+_now = getattr(time, 'monotonic', time.time)
+
 
 # Basic events used for thread scheduling.
 
 class Event(object):
     """Just a base class identifying Bluelet events. An event is an
     object yielded from a Bluelet thread coroutine to suspend operation
-    and communicate with the scheduler.
+    and communicate with the scheduler. Native coroutines await events
+    instead of yielding them.
     """
-    pass
+    if PY3:
+        __await__ = _await
 
 class WaitableEvent(Event):
     """A waitable event is one encapsulating an action that can be
@@ -54,10 +85,19 @@ class WaitableEvent(Event):
 
     def fire(self):
         """Called when an associated file descriptor becomes ready
-        (i.e., is returned from a select() call).
+        (i.e., is returned from a select() call). The return value is
+        sent to the waiting thread, except that returning PENDING (or
+        raising a socket error indicating that the operation would
+        block) keeps the thread waiting on the event.
         """
         pass
 
+PENDING = object()  # Returned from fire() when the event isn't done yet.
+
+# Socket error codes indicating that a non-blocking operation would
+# block.
+_WOULDBLOCK = frozenset((errno.EAGAIN, errno.EWOULDBLOCK))
+
 class ValueEvent(Event):
     """An event that does nothing but return a fixed value."""
     def __init__(self, value):
@@ -73,6 +113,11 @@ class SpawnEvent(Event):
     def __init__(self, coro):
         self.spawned = coro
 
+class _SpawnManyEvent(Event):
+    """Add several new coroutine threads to the scheduler at once."""
+    def __init__(self, coros):
+        self.spawned = coros
+
 class JoinEvent(Event):
     """Suspend the thread until the specified child thread has
     completed.
@@ -86,28 +131,46 @@ class KillEvent(Event):
         self.child = child
 
 class DelegationEvent(Event):
-    """Suspend execution of the current thread, start a new thread and,
-    once the child thread finished, return control to the parent
-    thread.
+    """Suspend execution of the current coroutine and run a
+    sub-coroutine in the same thread. Once the sub-coroutine finishes,
+    control returns to the caller.
     """
     def __init__(self, coro):
         self.spawned = coro
 
 class ReturnEvent(Event):
-    """Return a value the current thread's delegator at the point of
-    delegation. Ends the current (delegate) thread.
+    """Return a value to the current coroutine's caller at the point of
+    the call. Ends the current coroutine (or the thread, if it is the
+    outermost coroutine).
     """
     def __init__(self, value):
         self.value = value
 
+class TimeoutEvent(Event):
+    """Wait for another event, but give up after a given number of
+    seconds by raising a Timeout exception in the thread.
+    """
+    def __init__(self, event, duration):
+        self.event = event
+        self.duration = duration
+
+class FutureEvent(Event):
+    """Suspend the thread until a concurrent.futures.Future (or an
+    object with the same interface) completes, which may happen in a
+    different OS thread. Returns the future's result or raises its
+    exception.
+    """
+    def __init__(self, future):
+        self.future = future
+
 class SleepEvent(WaitableEvent):
     """Suspend the thread for a given duration.
     """
     def __init__(self, duration):
-        self.wakeup_time = time.time() + duration
+        self.wakeup_time = _now() + duration
 
     def time_left(self):
-        return max(self.wakeup_time - time.time(), 0.0)
+        return max(self.wakeup_time - _now(), 0.0)
 
 class ReadEvent(WaitableEvent):
     """Reads from a file-like object."""
@@ -127,264 +190,1295 @@ class WriteEvent(WaitableEvent):
         self.fd = fd
         self.data = data
 
-    def waitable(self):
+    def waitables(self):
         return (), (self.fd,), ()
 
     def fire(self):
         self.fd.write(self.data)
 
 
-# Core logic for executing and scheduling threads.
+# Backends for waiting on file descriptor readiness. Each backend keeps
+# a persistent registration of file descriptors and their "interest
+# masks" (some combination of READ, WRITE and EXCEPT) so that the
+# kernel-level state only changes when the set of waiting threads does.
 
-def _event_select(events):
-    """Perform a select() over all the Events provided, returning the
-    ones ready to be fired. Only WaitableEvents (including SleepEvents)
-    matter here; all other events are ignored (and thus postponed).
-    """
-    # Gather waitables and wakeup times.
-    waitable_to_event = {}
-    rlist, wlist, xlist = [], [], []
-    earliest_wakeup = None
-    for event in events:
-        if isinstance(event, SleepEvent):
-            if not earliest_wakeup:
-                earliest_wakeup = event.wakeup_time
-            else:
-                earliest_wakeup = min(earliest_wakeup, event.wakeup_time)
-        elif isinstance(event, WaitableEvent):
-            r, w, x = event.waitables()
-            rlist += r
-            wlist += w
-            xlist += x
-            for waitable in r:
-                waitable_to_event[('r', waitable)] = event
-            for waitable in w:
-                waitable_to_event[('w', waitable)] = event
-            for waitable in x:
-                waitable_to_event[('x', waitable)] = event
-
-    # If we have a any sleeping threads, determine how long to sleep.
-    if earliest_wakeup:
-        timeout = max(earliest_wakeup - time.time(), 0.0)
-    else:
-        timeout = None
+READ = 1
+WRITE = 2
+EXCEPT = 4
 
-    # Perform select() if we have any waitables.
-    if rlist or wlist or xlist:
+class SelectBackend(object):
+    """A backend using the portable select() call. It works everywhere
+    but is limited to FD_SETSIZE (usually 1024) file descriptors and
+    does work proportional to the total number of registered
+    descriptors on every wait.
+    """
+    name = 'select'
+
+    def __init__(self):
+        self.registered = {}
+
+    def register(self, fd, mask):
+        """Start watching a file descriptor for the given conditions."""
+        self.registered[fd] = mask
+
+    def modify(self, fd, mask):
+        """Change the conditions watched for a registered descriptor."""
+        self.registered[fd] = mask
+
+    def unregister(self, fd):
+        """Stop watching a file descriptor."""
+        del self.registered[fd]
+
+    def update(self, fd, mask):
+        """Set the interest mask for a descriptor, registering,
+        modifying or unregistering it as necessary. A mask of 0 means
+        the descriptor should no longer be watched. Nothing happens if
+        the interest has not changed.
+        """
+        old = self.registered.get(fd)
+        if not mask:
+            if old is not None:
+                self.unregister(fd)
+        elif old is None:
+            self.register(fd, mask)
+        elif old != mask:
+            self.modify(fd, mask)
+
+    def poll(self, timeout):
+        """Wait for up to `timeout` seconds (or indefinitely if timeout
+        is None) and return a list of (fd, mask) pairs for the
+        descriptors that are ready.
+        """
+        rlist, wlist, xlist = [], [], []
+        for fd, mask in self.registered.items():
+            if mask & READ:
+                rlist.append(fd)
+            if mask & WRITE:
+                wlist.append(fd)
+            if mask & EXCEPT:
+                xlist.append(fd)
+
+        if not self.registered:
+            # select() refuses empty lists on some platforms.
+            if timeout:
+                time.sleep(timeout)
+            return []
         rready, wready, xready = select.select(rlist, wlist, xlist, timeout)
-    else:
-        rready, wready, xready = (), (), ()
-        if timeout:
-            time.sleep(timeout)
-
-    # Gather ready events corresponding to the ready waitables.
-    ready_events = set()
-    for ready in rready:
-        ready_events.add(waitable_to_event[('r', ready)])
-    for ready in wready:
-        ready_events.add(waitable_to_event[('w', ready)])
-    for ready in xready:
-        ready_events.add(waitable_to_event[('x', ready)])
-
-    # Gather any finished sleeps.
-    for event in events:
-        if isinstance(event, SleepEvent) and event.time_left() == 0.0:
-            ready_events.add(event)
-
-    return ready_events
 
-class ThreadException(Exception):
-    def __init__(self, coro, exc_info):
-        self.coro = coro
-        self.exc_info = exc_info
-    def reraise(self):
-        _reraise(self.exc_info[0], self.exc_info[1], self.exc_info[2])
+        ready = collections.defaultdict(int)
+        for fd in rready:
+            ready[fd] |= READ
+        for fd in wready:
+            ready[fd] |= WRITE
+        for fd in xready:
+            ready[fd] |= EXCEPT
+        return list(ready.items())
 
-SUSPENDED = Event()  # Special sentinel placeholder for suspended threads.
+    def close(self):
+        """Release any resources held by the backend."""
+        self.registered = {}
 
-class Delegated(Event):
-    """Placeholder indicating that a thread has delegated execution to a
-    different thread.
+class PollBackend(SelectBackend):
+    """A backend using the poll() system call, which has no limit on
+    the number of file descriptors.
     """
-    def __init__(self, child):
-        self.child = child
+    name = 'poll'
+
+    def __init__(self):
+        super(PollBackend, self).__init__()
+        self._poller = select.poll()
+        self._in = select.POLLIN
+        self._out = select.POLLOUT
+        self._pri = select.POLLPRI
+        self._err = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+    def _kernel_mask(self, mask):
+        kmask = 0
+        if mask & READ:
+            kmask |= self._in
+        if mask & WRITE:
+            kmask |= self._out
+        if mask & EXCEPT:
+            kmask |= self._pri
+        return kmask
+
+    def register(self, fd, mask):
+        self._poller.register(fd, self._kernel_mask(mask))
+        self.registered[fd] = mask
+
+    def modify(self, fd, mask):
+        self._poller.modify(fd, self._kernel_mask(mask))
+        self.registered[fd] = mask
+
+    def unregister(self, fd):
+        del self.registered[fd]
+        try:
+            self._poller.unregister(fd)
+        except (KeyError, ValueError, IOError, OSError):
+            # The descriptor was already closed, which implicitly
+            # removes it from some kernel pollers.
+            pass
+
+    def _wait(self, timeout):
+        if timeout is None:
+            return self._poller.poll()
+        # poll() takes milliseconds. Round up to avoid spinning.
+        return self._poller.poll(int(math.ceil(timeout * 1000)))
+
+    def poll(self, timeout):
+        if not self.registered:
+            if timeout:
+                time.sleep(timeout)
+            return []
+
+        out = []
+        for fd, kmask in self._wait(timeout):
+            mask = 0
+            if kmask & (self._in | self._err):
+                mask |= READ
+            if kmask & (self._out | self._err):
+                mask |= WRITE
+            if kmask & self._pri:
+                mask |= EXCEPT
+            # Only report the conditions that were asked for.
+            mask &= self.registered.get(fd, 0)
+            if mask:
+                out.append((fd, mask))
+        return out
+
+class EpollBackend(PollBackend):
+    """A backend using Linux's epoll facility. Waiting costs time
+    proportional to the number of *ready* descriptors rather than the
+    number of registered ones.
+    """
+    name = 'epoll'
 
-def run(root_coro):
-    """Schedules a coroutine, running it to completion. This
-    encapsulates the Bluelet scheduler, which the root coroutine can
-    add to by spawning new coroutines.
+    def __init__(self):
+        SelectBackend.__init__(self)
+        self._poller = select.epoll()
+        self._in = select.EPOLLIN
+        self._out = select.EPOLLOUT
+        self._pri = select.EPOLLPRI
+        self._err = select.EPOLLERR | select.EPOLLHUP
+
+        # Descriptors epoll refuses to watch (i.e., regular files), which
+        # are always considered ready, as select() would report them.
+        self._always = {}
+
+    def register(self, fd, mask):
+        try:
+            super(EpollBackend, self).register(fd, mask)
+        except (IOError, OSError) as exc:
+            if exc.errno == errno.EEXIST:
+                # Stale kernel registration for a reused descriptor.
+                self.modify(fd, mask)
+            elif exc.errno == errno.EPERM:
+                self._always[fd] = mask
+                self.registered[fd] = mask
+            else:
+                raise
+
+    def modify(self, fd, mask):
+        if fd in self._always:
+            self._always[fd] = mask
+            self.registered[fd] = mask
+        else:
+            super(EpollBackend, self).modify(fd, mask)
+
+    def unregister(self, fd):
+        if fd in self._always:
+            del self._always[fd]
+            del self.registered[fd]
+        else:
+            super(EpollBackend, self).unregister(fd)
+
+    def _wait(self, timeout):
+        if self._always:
+            timeout = 0
+        elif timeout is None:
+            timeout = -1
+        ready = self._poller.poll(timeout)
+        if self._always:
+            ready = list(ready) + [(fd, self._kernel_mask(mask))
+                                   for fd, mask in self._always.items()]
+        return ready
+
+    def close(self):
+        super(EpollBackend, self).close()
+        self._always = {}
+        self._poller.close()
+
+BACKENDS = collections.OrderedDict([('select', SelectBackend)])
+if hasattr(select, 'poll'):
+    BACKENDS['poll'] = PollBackend
+if hasattr(select, 'epoll'):
+    BACKENDS['epoll'] = EpollBackend
+
+def _make_backend(backend):
+    """Get a backend instance for the `backend` argument to run(), which
+    may be None (use the most scalable available backend), the name of
+    a backend, or a backend object.
     """
-    # The "threads" dictionary keeps track of all the currently-
-    # executing and suspended coroutines. It maps coroutines to their
-    # currently "blocking" event. The event value may be SUSPENDED if
-    # the coroutine is waiting on some other condition: namely, a
-    # delegated coroutine or a joined coroutine. In this case, the
-    # coroutine should *also* appear as a value in one of the below
-    # dictionaries `delegators` or `joiners`.
-    threads = {root_coro: ValueEvent(None)}
+    if backend is None:
+        backend = list(BACKENDS)[-1]
+    if isinstance(backend, str):
+        try:
+            return BACKENDS[backend]()
+        except KeyError:
+            raise ValueError('unknown or unsupported backend %s' % backend)
+    return backend
+
+
+# Core logic for executing and scheduling threads.
+
+def _fileno(waitable):
+    """Get the file descriptor number for a waitable object."""
+    if isinstance(waitable, int):
+        return waitable
+    return waitable.fileno()
+
+class _Registry(object):
+    """Tracks the WaitableEvents that threads are blocked on. Events
+    are registered when a thread starts waiting and unregistered when
+    they fire, and only the descriptors whose interest changed in the
+    meantime are pushed to the backend. So a thread that repeatedly
+    waits on the same socket costs no backend calls at all.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+        # Maps each registered event to its thread and the (mask, fd)
+        # keys it is waiting on.
+        self.events = {}
+
+        # Maps (mask, fd) keys to the events waiting on them, in order
+        # of registration.
+        self.waiters = {}
+
+        # The object whose descriptor was last registered for each fd.
+        # A different object with the same fd means the old one was
+        # closed and its number reused; the kernel may have silently
+        # dropped the old registration.
+        self.owners = {}
+
+        # Descriptors whose interest may have changed since the last
+        # flush, and those that need to be re-registered from scratch.
+        self.dirty = set()
+        self.stale = set()
+
+    def __contains__(self, event):
+        return event in self.events
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event, coro):
+        """Register an event that a thread is waiting on."""
+        keys = []
+        for mask, waitables in zip((READ, WRITE, EXCEPT), event.waitables()):
+            for waitable in waitables:
+                fd = _fileno(waitable)
+                if self.owners.get(fd, waitable) is not waitable:
+                    self.stale.add(fd)
+                self.owners[fd] = waitable
+                key = (mask, fd)
+                if key not in self.waiters:
+                    self.waiters[key] = collections.deque()
+                self.waiters[key].append(event)
+                self.dirty.add(fd)
+                keys.append(key)
+        self.events[event] = (coro, keys)
+
+    def remove(self, event):
+        """Unregister an event, returning the thread that was waiting
+        on it.
+        """
+        coro, keys = self.events.pop(event)
+        for key in keys:
+            waiters = self.waiters[key]
+            waiters.remove(event)
+            if not waiters:
+                del self.waiters[key]
+            self.dirty.add(key[1])
+        return coro
+
+    def clear(self):
+        """Unregister all events."""
+        for event in list(self.events):
+            self.remove(event)
+        self.flush()
+
+    def flush(self):
+        """Push changed interests to the backend."""
+        for fd in self.dirty:
+            mask = 0
+            for bit in (READ, WRITE, EXCEPT):
+                if (bit, fd) in self.waiters:
+                    mask |= bit
+            if fd in self.stale and fd in self.backend.registered:
+                self.backend.unregister(fd)
+            self.backend.update(fd, mask)
+            if not mask:
+                self.owners.pop(fd, None)
+        self.dirty.clear()
+        self.stale.clear()
+
+    def poll(self, timeout):
+        """Wait for registered events to become ready and return a list
+        of (coro, event) pairs for the events that can be fired.
+        """
+        self.flush()
+        if not self.events:
+            if timeout:
+                time.sleep(timeout)
+            return []
+
+        ready = []
+        seen = set()
+        for fd, ready_mask in self.backend.poll(timeout):
+            for mask in (READ, WRITE, EXCEPT):
+                if ready_mask & mask and (mask, fd) in self.waiters:
+                    event = self.waiters[(mask, fd)][0]
+                    if event not in seen:
+                        seen.add(event)
+                        ready.append((self.events[event][0], event))
+        return ready
+
+class _Timers(object):
+    """A queue of timers ordered by deadline in a binary heap, so
+    finding the next deadline is O(1) and adding or expiring a timer is
+    O(log n). Cancelling a timer just marks its entry; dead entries are
+    skipped when they reach the top of the heap, and the heap is rebuilt
+    when they outnumber the live ones.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()  # Tie-breaker for equal deadlines.
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def add(self, deadline, func, *args):
+        """Call func(*args) once the monotonic clock reaches deadline.
+        Returns an entry that can be passed to cancel().
+        """
+        entry = [deadline, next(self.counter), func, args]
+        heapq.heappush(self.heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        """Disarm a timer that has not yet expired."""
+        if entry[2] is not None:
+            entry[2] = entry[3] = None
+            self.cancelled += 1
+            if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+                self.heap[:] = [e for e in self.heap if e[2] is not None]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def _prune(self):
+        heap = self.heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+
+    def timeout(self):
+        """Get the number of seconds until the next deadline, or None
+        if there are no timers.
+        """
+        self._prune()
+        if not self.heap:
+            return None
+        return max(self.heap[0][0] - _now(), 0.0)
+
+    def expire(self):
+        """Remove and generate the (func, args) pairs for all timers
+        whose deadline has passed. Timers are removed one at a time, so
+        a timer may be cancelled by the callback of an earlier one.
+        """
+        heap = self.heap
+        now = _now()
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if entry[2] is None:
+                self.cancelled -= 1
+            else:
+                func, args = entry[2], entry[3]
+                entry[2] = entry[3] = None
+                yield func, args
+
+class Timeout(Exception):
+    """Raised in a thread when an operation given a timeout takes too
+    long.
+    """
+    pass
+
+def _exc_info(exc):
+    """Get an exc_info triple for an exception object, suitable for
+    raising in a thread.
+    """
+    try:
+        raise exc
+    except:
+        return sys.exc_info()
+
+def _future_outcome(future):
+    """Get the result of a completed future as a (value, is_exc) pair
+    for advancing a thread.
+    """
+    try:
+        return future.result(), False
+    except:
+        return sys.exc_info(), True
+
+class _Waker(object):
+    """Lets other OS threads (such as workers completing futures) hand
+    callbacks to the scheduler's thread. Callbacks are queued and a
+    byte is written to a socket pair whose other end the scheduler
+    watches, so it wakes up from a blocking poll to run them.
+    """
+    def __init__(self):
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+        self.callbacks = collections.deque()  # Thread-safe appends/pops.
+        self.event = _WakeupEvent(self)
+
+    def call(self, func, *args):
+        """Run func(*args) in the scheduler's thread soon. May be called
+        from any thread.
+        """
+        self.callbacks.append((func, args))
+        try:
+            self.wsock.send(b'\0')
+        except socket.error:
+            pass  # The buffer is full, so a wakeup is pending anyway.
 
-    # Maps child coroutines to delegating parents.
-    delegators = {}
+    def run(self):
+        """Run the queued callbacks. Called in the scheduler's thread."""
+        try:
+            while self.rsock.recv(4096):
+                pass
+        except socket.error:
+            pass
+        callbacks = self.callbacks
+        while callbacks:
+            func, args = callbacks.popleft()
+            func(*args)
 
-    # Maps child coroutines to joining (exit-waiting) parents.
-    joiners = collections.defaultdict(list)
+    def close(self):
+        self.rsock.close()
+        self.wsock.close()
 
-    # History of spawned coroutines for joining of already completed
-    # coroutines.
-    history = weakref.WeakKeyDictionary({root_coro: None})
+class _WakeupEvent(WaitableEvent):
+    """Runs a _Waker's callbacks whenever its socket is readable."""
+    def __init__(self, waker):
+        self.waker = waker
 
-    def complete_thread(coro, return_value):
-        """Remove a coroutine from the scheduling pool, awaking
-        delegators and joiners as necessary and returning the specified
-        value to any delegating parent.
+    def waitables(self):
+        return (self.waker.rsock,), (), ()
+
+    def fire(self):
+        self.waker.run()
+        return PENDING  # Stay registered.
+
+class _WaitQueue(object):
+    """A FIFO of threads waiting for something that another thread,
+    rather than an IO event, will provide (for example, a connection
+    returned to a pool). Threads wait by yielding wait(); wake() resumes
+    the longest-waiting one. It may be called from plain methods.
+    Waiting threads can leave a value (say, an item to be added to a
+    full queue) for the thread that wakes them.
+    """
+    def __init__(self):
+        self.waiters = collections.deque()  # (scheduler, coro, event)
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def wait(self, value=None):
+        """Event: suspend the thread until it is woken."""
+        return _ParkEvent(self, value)
+
+    def wake(self, value=None):
+        """Resume the first waiting thread with value. Returns the event
+        it was waiting on, or None if no thread was waiting.
         """
-        del threads[coro]
+        waiters = self.waiters
+        while waiters:
+            scheduler, coro, event = waiters.popleft()
+            if scheduler.threads.get(coro) is event:  # Still waiting.
+                scheduler.resume(coro, value)
+                return event
+        return None
+
+class _ParkEvent(Event):
+    """Suspend the thread on a _WaitQueue, leaving a value there."""
+    def __init__(self, queue, value=None):
+        self.queue = queue
+        self.value = value
 
-        # Resume delegator.
-        if coro in delegators:
-            threads[delegators[coro]] = ValueEvent(return_value)
-            del delegators[coro]
+class ThreadException(Exception):
+    def __init__(self, coro, exc_info):
+        self.coro = coro
+        self.exc_info = exc_info
+    def reraise(self):
+        _reraise(self.exc_info[0], self.exc_info[1], self.exc_info[2])
+
+class Task(object):
+    """A handle on a thread started with `spawn`, which records how the
+    thread ended: its return value (as given to `end`) or the exception
+    it raised. Pass it to `join` to wait for the thread to finish and
+    get the result, or to `kill` to stop it.
+    """
+    def __init__(self, coro):
+        self._coro = weakref.ref(coro)
+        self._done = False
+        self._value = None
+        self._is_exc = False
+
+    @property
+    def coro(self):
+        """The thread's coroutine, or None once it has been freed."""
+        return self._coro()
+
+    def done(self):
+        """Return whether the thread has finished."""
+        return self._done
+
+    def result(self):
+        """Return the thread's result, or raise the exception it
+        raised. The thread must have finished.
+        """
+        if not self._done:
+            raise RuntimeError('thread has not finished')
+        if self._is_exc:
+            _reraise(*self._value)
+        return self._value
+
+    def exception(self):
+        """Return the exception the finished thread raised, or None."""
+        if self._is_exc:
+            return self._value[1]
+        return None
+
+    def _finish(self, value, is_exc):
+        self._done = True
+        self._value = value
+        self._is_exc = is_exc
+
+SUSPENDED = Event()  # Special sentinel placeholder for runnable threads.
+
+class _Scheduler(object):
+    """The state of a running Bluelet scheduler. Threads that can run
+    immediately wait in a ready queue, so the cost of resuming a thread
+    does not depend on how many other threads are blocked. The events
+    yielded by threads are dispatched on their type through a table of
+    handlers.
+
+    A thread is identified by its outermost coroutine. When it calls a
+    sub-coroutine, the callee is pushed onto the thread's call stack
+    and run right away; when it returns, it is popped and the caller
+    continues, all without going back through the scheduler's loop.
+    """
+    def __init__(self, root_coro, backend):
+        self.root_coro = root_coro
+
+        # The "threads" dictionary keeps track of all the currently-
+        # executing and suspended threads. It maps their (outermost)
+        # coroutines to their currently "blocking" event, which is
+        # SUSPENDED if the thread is in the ready queue.
+        self.threads = {}
+
+        # The call stacks of threads that are running sub-coroutines,
+        # as lists of coroutines from the outermost to the innermost.
+        self.stacks = {}
+
+        # Timeouts on sub-coroutine calls, as stacks of (caller's
+        # depth, timer entry) pairs for each thread.
+        self.calls = {}
+
+        # The depth of a timed-out call in threads that were handed a
+        # value before the timeout fired; the call is abandoned when the
+        # thread next waits.
+        self.overdue = {}
+
+        # Threads that can be advanced right away, as (coro, value,
+        # is_exc) triples (see advance()).
+        self.ready = collections.deque()
+
+        # Waitable events that threads are blocked on, registered with
+        # the backend across loop iterations.
+        self.registry = _Registry(_make_backend(backend))
+
+        # Pending timers, and the timer entries for sleeping threads
+        # and for threads waiting with a timeout.
+        self.timers = _Timers()
+        self.sleepers = {}
+        self.deadlines = {}
+
+        # Connections with coalesced writes to send at the end of this
+        # pass through the loop.
+        self.corked = set()
+
+        # Receives callbacks from other OS threads; created on demand.
+        self.waker = None
+
+        # Maps child coroutines to joining (exit-waiting) parents.
+        self.joiners = collections.defaultdict(list)
+
+        # History of spawned coroutines for joining of already
+        # completed coroutines, mapped to their Tasks (or None for the
+        # root).
+        self.history = weakref.WeakKeyDictionary()
+
+        # The exception from a thread that nobody joined, which ends
+        # the run.
+        self.exit_te = None
+
+        # Event handlers, keyed by event type. Subclasses of these
+        # types are resolved by handler() and cached here.
+        self.handlers = {
+            ValueEvent: self._on_value,
+            ExceptionEvent: self._on_exception,
+            SpawnEvent: self._on_spawn,
+            _SpawnManyEvent: self._on_spawn_many,
+            ReturnEvent: self._on_return,
+            JoinEvent: self._on_join,
+            KillEvent: self._on_kill,
+            SleepEvent: self._on_sleep,
+            WaitableEvent: self._on_waitable,
+            TimeoutEvent: self._on_timeout,
+            CoalescedSendEvent: self._on_coalesced_send,
+            FutureEvent: self._on_future,
+            _ParkEvent: self._on_park,
+        }
+
+        if root_coro is not None:
+            self.add_thread(root_coro)
+
+    def handler(self, event):
+        """Get the handler for an event yielded by a thread."""
+        typ = type(event)
+        try:
+            return self.handlers[typ]
+        except KeyError:
+            pass
+        for base in typ.__mro__:
+            if base in self.handlers:
+                handler = self.handlers[base]
+                break
+        else:
+            # Not a Bluelet event. The thread stays blocked forever.
+            handler = None
+        self.handlers[typ] = handler
+        return handler
+
+    def resume(self, coro, value=None, is_exc=False):
+        """Make a thread runnable, to be advanced with the given value
+        (or exception).
+        """
+        if coro in self.deadlines:
+            self.timers.cancel(self.deadlines.pop(coro))
+        self.threads[coro] = SUSPENDED
+        self.ready.append((coro, value, is_exc))
+
+    def cancel_wait(self, coro):
+        """Stop a thread from waiting on its current event, so it can be
+        resumed some other way.
+        """
+        event = self.threads[coro]
+        if event is SUSPENDED:
+            # Take it out of the ready queue instead.
+            for entry in self.ready:
+                if entry[0] is coro:
+                    self.ready.remove(entry)
+                    break
+        elif event in self.registry:
+            self.registry.remove(event)
+            if isinstance(event, SendEvent) and event.sendall and \
+                    event.conn._wqueue and not event.conn._closed:
+                # Nobody waits for the rest of the data now.
+                self.drain(event.conn)
+        elif coro in self.sleepers:
+            self.timers.cancel(self.sleepers.pop(coro))
+        elif isinstance(event, JoinEvent):
+            self.joiners[event.child].remove(coro)
+            if not self.joiners[event.child]:
+                del self.joiners[event.child]
+        elif isinstance(event, _ParkEvent):
+            event.queue.waiters.remove((self, coro, event))
+
+    def add_thread(self, coro, task=None):
+        """Add a new coroutine to the scheduler."""
+        self.history[coro] = task
+        self.resume(coro)
+
+    def complete_thread(self, coro, return_value):
+        """Remove a thread from the scheduling pool, awaking joiners as
+        necessary and recording the return value on its Task.
+        """
+        event = self.threads.pop(coro)
+        if event in self.registry:
+            self.registry.remove(event)
+        if coro in self.sleepers:
+            self.timers.cancel(self.sleepers.pop(coro))
+        if coro in self.deadlines:
+            self.timers.cancel(self.deadlines.pop(coro))
+        if coro in self.stacks:
+            del self.stacks[coro]
+            for _, entry in self.calls.pop(coro, ()):
+                self.timers.cancel(entry)
+            self.overdue.pop(coro, None)
+        task = self.history.get(coro)
+        if task is not None:
+            task._finish(return_value, False)
 
         # Resume joiners.
-        if coro in joiners:
-            for parent in joiners[coro]:
-                threads[parent] = ValueEvent(None)
-            del joiners[coro]
-
-    def advance_thread(coro, value, is_exc=False):
-        """After an event is fired, run a given coroutine associated with
-        it in the threads dict until it yields again. If the coroutine
-        exits, then the thread is removed from the pool. If the coroutine
-        raises an exception, it is reraised in a ThreadException. If
-        is_exc is True, then the value must be an exc_info tuple and the
-        exception is thrown into the coroutine.
+        if coro in self.joiners:
+            for parent in self.joiners.pop(coro):
+                self.resume(parent, return_value)
+
+    def fail_thread(self, coro, exc_info):
+        """Record the exception that ended a spawned thread on its Task
+        and raise it in any joining threads. Returns whether there were
+        any.
+        """
+        task = self.history.get(coro)
+        if task is not None:
+            task._finish(exc_info, True)
+        joiners = self.joiners.pop(coro, ())
+        for parent in joiners:
+            self.resume(parent, exc_info, True)
+        return bool(joiners)
+
+    def advance(self, coro, value, is_exc=False):
+        """After an event is fired, run a given thread associated with
+        it in the threads dict until it yields again. If the thread
+        exits, then it is removed from the pool. If the thread raises
+        an exception, it is reraised in a ThreadException. If is_exc is
+        True, then the value must be an exc_info tuple and the exception
+        is thrown into the thread's innermost coroutine.
+
+        An event's handler can return a (value, is_exc) pair to have
+        the thread continue right away, without a trip through the
+        ready queue. Sub-coroutine calls and returns work this way.
         """
+        if coro in self.deadlines:
+            self.timers.cancel(self.deadlines.pop(coro))
+        stacks = self.stacks
+        stack = stacks.get(coro)
+        frame = stack[-1] if stack else coro
+        while True:
+            try:
+                if is_exc:
+                    next_event = frame.throw(*value)
+                else:
+                    next_event = frame.send(value)
+            except StopIteration as exc:
+                # Under PEP 380, this carries the return value.
+                value = getattr(exc, 'value', None)
+                if frame is coro:
+                    # Thread is done.
+                    self.complete_thread(coro, value)
+                    return
+                # Return to the caller.
+                frame = self.pop_call(coro)
+                is_exc = False
+                continue
+            except:
+                if frame is coro:
+                    # Thread raised some other exception.
+                    del self.threads[coro]
+                    raise ThreadException(coro, sys.exc_info())
+                # Raise the exception in the caller.
+                value, is_exc = sys.exc_info(), True
+                frame = self.pop_call(coro)
+                continue
+
+            # Calls and returns are the most common events, so they
+            # skip the handler table. Yielding a coroutine is shorthand
+            # for an explicit bluelet.call().
+            typ = type(next_event)
+            if typ in _COROUTINE_TYPES:
+                frame = self.push_call(coro, next_event)
+                value, is_exc = None, False
+                continue
+            if isinstance(next_event, DelegationEvent):
+                frame = self.push_call(coro, next_event.spawned)
+                value, is_exc = None, False
+                continue
+            if typ is ReturnEvent and frame is not coro:
+                value, is_exc = next_event.value, False
+                frame = self.pop_call(coro)
+                continue
+
+            if coro in self.overdue:
+                # A call timed out while the thread was taking a value.
+                frame = self.unwind_call(coro, self.overdue[coro])
+                value, is_exc = _exc_info(Timeout()), True
+                continue
+
+            self.threads[coro] = next_event
+            handler = self.handler(next_event)
+            if handler:
+                cont = handler(coro, next_event)
+                if cont:
+                    value, is_exc = cont
+                    stack = stacks.get(coro)
+                    frame = stack[-1] if stack else coro
+                    continue
+            return
+
+    def push_call(self, coro, callee):
+        """Start running a sub-coroutine in a thread. Returns the
+        callee.
+        """
+        stack = self.stacks.get(coro)
+        if stack is None:
+            stack = self.stacks[coro] = [coro]
+        stack.append(callee)
+        return callee
+
+    def pop_call(self, coro):
+        """End the innermost sub-coroutine call in a thread, cancelling
+        any timeout on the call. Returns the caller.
+        """
+        stack = self.stacks[coro]
+        stack.pop()
+        depth = len(stack) - 1
+        if not depth:
+            del self.stacks[coro]
+        if coro in self.calls:
+            calls = self.calls[coro]
+            while calls and calls[-1][0] == depth:
+                self.timers.cancel(calls.pop()[1])
+            if not calls:
+                del self.calls[coro]
+            if self.overdue.get(coro) == depth:
+                del self.overdue[coro]
+        return stack[-1]
+
+    def unwind_call(self, coro, depth):
+        """Abandon the sub-coroutine call made at a depth in a thread's
+        stack, along with the calls made inside it and their timeouts.
+        Returns the caller.
+        """
+        calls = self.calls[coro]
+        while calls and calls[-1][0] >= depth:
+            self.timers.cancel(calls.pop()[1])
+        if not calls:
+            del self.calls[coro]
+        if self.overdue.get(coro, -1) >= depth:
+            del self.overdue[coro]
+        stack = self.stacks[coro]
+        del stack[depth + 1:]
+        if not depth:
+            del self.stacks[coro]
+        return stack[-1]
+
+    def kill_thread(self, coro):
+        """Unschedule this thread, including any sub-coroutines it is
+        running.
+        """
+        self.cancel_wait(coro)
+        self.complete_thread(coro, None)
+
+    # Handlers for each type of event.
+
+    def _on_value(self, coro, event):
+        self.resume(coro, event.value)
+
+    def _on_exception(self, coro, event):
+        self.resume(coro, event.exc_info, True)
+
+    def _on_spawn(self, coro, event):
+        task = Task(event.spawned)
+        self.resume(coro, task)
+        self.add_thread(event.spawned, task)
+
+    def _on_spawn_many(self, coro, event):
+        tasks = [Task(child) for child in event.spawned]
+        self.resume(coro, tasks)
+        for task, child in zip(tasks, event.spawned):
+            self.add_thread(child, task)
+
+    def _on_return(self, coro, event):
+        if coro in self.stacks:
+            # Return the value to the caller.
+            self.pop_call(coro)
+            return event.value, False
+        # Thread is done.
+        self.complete_thread(coro, event.value)
+
+    def _on_join(self, coro, event):
+        if event.child not in self.threads and event.child in self.history:
+            task = self.history[event.child]
+            if task is None:
+                self.resume(coro)
+            else:
+                self.resume(coro, task._value, task._is_exc)
+        else:
+            self.threads[coro] = event  # Suspend.
+            self.joiners[event.child].append(coro)
+
+    def _on_kill(self, coro, event):
+        self.resume(coro)
+        if event.child in self.threads:
+            self.kill_thread(event.child)
+
+    def _on_sleep(self, coro, event):
+        self.sleepers[coro] = self.timers.add(event.wakeup_time,
+                                              self._wake_sleeper, coro)
+
+    def _on_waitable(self, coro, event):
+        self.registry.add(event, coro)
+
+    def _on_timeout(self, coro, event):
+        inner = event.event
+        while isinstance(inner, TimeoutEvent):
+            inner = inner.event
+        if isinstance(inner, DelegationEvent):
+            # A timeout on a whole sub-coroutine call, which lasts until
+            # it returns. Ones wrapped around it are on the same call.
+            stack = self.stacks.get(coro)
+            depth = len(stack) - 1 if stack else 0
+            entry = self.timers.add(_now() + event.duration,
+                                    self._expire_call, coro, depth)
+            self.calls.setdefault(coro, []).append((depth, entry))
+            if inner is not event.event:
+                return self._on_timeout(coro, event.event)
+            self.push_call(coro, inner.spawned)
+            return None, False
+
+        # Timeouts can be nested; the thread keeps the earliest deadline.
+        deadline = _now() + event.duration
+        entry = self.deadlines.get(coro)
+        if entry is None or deadline < entry[0]:
+            if entry is not None:
+                self.timers.cancel(entry)
+            self.deadlines[coro] = self.timers.add(deadline, self._expire,
+                                                   coro, deadline)
+        self.threads[coro] = event.event
+        handler = self.handler(event.event)
+        if handler:
+            cont = handler(coro, event.event)
+            if cont and coro in self.deadlines:
+                self.timers.cancel(self.deadlines.pop(coro))
+            return cont
+
+    def _on_coalesced_send(self, coro, event):
+        # The thread keeps running until it blocks; its writes are sent
+        # after that.
+        self.corked.add(event.conn)
+        event.conn._drain.scheduler = self
+        return None, False
+
+    def _on_future(self, coro, event):
+        future = event.future
+        if future.done():
+            return _future_outcome(future)
+        if not self.waker:
+            self.waker = _Waker()
+            self.registry.add(self.waker.event, None)
+        waker = self.waker
+        future.add_done_callback(
+            lambda f: waker.call(self._future_done, coro, event)
+        )
+
+    def _on_park(self, coro, event):
+        event.queue.waiters.append((self, coro, event))
+
+    def _future_done(self, coro, event):
+        if self.threads.get(coro) is event:  # Still waiting.
+            value, is_exc = _future_outcome(event.future)
+            self.resume(coro, value, is_exc)
+
+    def _expire(self, coro, deadline):
+        entry = self.deadlines.get(coro)
+        if entry is None or entry[0] != deadline:
+            return  # A stale timer; the thread has moved on.
+        del self.deadlines[coro]
+        self.cancel_wait(coro)
+        self.resume(coro, _exc_info(Timeout()), True)
+
+    def _expire_call(self, coro, depth):
+        if self.threads[coro] is SUSPENDED:
+            # The thread has been handed a value (a queue item, say)
+            # that would be lost. Let it take it; the call times out
+            # when the thread next waits, unless it returns first.
+            if self.overdue.get(coro, depth) >= depth:
+                self.overdue[coro] = depth
+            return
+
+        # Abandon the call and raise Timeout in the caller.
+        self.cancel_wait(coro)
+        self.unwind_call(coro, depth)
+        self.resume(coro, _exc_info(Timeout()), True)
+
+    def _wake_sleeper(self, coro):
+        del self.sleepers[coro]
+        self.advance(coro, None)
+
+    # The main loop.
+
+    def fire(self, coro, event):
+        """Fire a ready event and advance the thread waiting on it."""
+        if event in self.registry:
+            self.registry.remove(event)
+
+        # Run the IO operation, but catch socket errors.
         try:
-            if is_exc:
-                next_event = coro.throw(*value)
+            value = event.fire()
+        except socket.error as exc:
+            if isinstance(exc.args, tuple) and \
+                    exc.args[0] in _WOULDBLOCK:
+                # Spurious wakeup: some other thread got there first.
+                self.registry.add(event, coro)
+                return
+            elif isinstance(exc.args, tuple) and \
+                    exc.args[0] == errno.EPIPE:
+                # Broken pipe. Remote host disconnected.
+                pass
+            elif isinstance(exc.args, tuple) and \
+                    exc.args[0] == errno.ECONNRESET:
+                # Connection was reset by peer.
+                pass
             else:
-                next_event = coro.send(value)
-        except StopIteration:
-            # Thread is done.
-            complete_thread(coro, None)
-        except:
-            # Thread raised some other exception.
-            del threads[coro]
-            raise ThreadException(coro, sys.exc_info())
+                traceback.print_exc()
+            # Abort the coroutine, returning None to its caller.
+            if coro in self.stacks:
+                self.pop_call(coro)
+                self.advance(coro, None)
+            else:
+                self.complete_thread(coro, None)
         else:
-            if isinstance(next_event, types.GeneratorType):
-                # Automatically invoke sub-coroutines. (Shorthand for
-                # explicit bluelet.call().)
-                next_event = DelegationEvent(next_event)
-            threads[coro] = next_event
-
-    def kill_thread(coro):
-        """Unschedule this thread and its (recursive) delegates.
-        """
-        # Collect all coroutines in the delegation stack.
-        coros = [coro]
-        while isinstance(threads[coro], Delegated):
-            coro = threads[coro].child
-            coros.append(coro)
-
-        # Complete each coroutine from the top to the bottom of the
-        # stack.
-        for coro in reversed(coros):
-            complete_thread(coro, None)
-
-    # Continue advancing threads until root thread exits.
-    exit_te = None
-    while threads:
+            if value is PENDING:
+                # Partial progress. Keep waiting.
+                self.registry.add(event, coro)
+            else:
+                self.advance(coro, value)
+
+    def fire_detached(self, event):
+        """Fire an event that the scheduler itself is waiting on, rather
+        than a thread. Errors just end the wait.
+        """
+        self.registry.remove(event)
         try:
-            # Look for events that can be run immediately. Continue
-            # running immediate events until nothing is ready.
-            while True:
-                have_ready = False
-                for coro, event in list(threads.items()):
-                    if isinstance(event, SpawnEvent):
-                        threads[event.spawned] = ValueEvent(None)  # Spawn.
-                        history[event.spawned] = None  # Record in history.
-                        advance_thread(coro, None)
-                        have_ready = True
-                    elif isinstance(event, ValueEvent):
-                        advance_thread(coro, event.value)
-                        have_ready = True
-                    elif isinstance(event, ExceptionEvent):
-                        advance_thread(coro, event.exc_info, True)
-                        have_ready = True
-                    elif isinstance(event, DelegationEvent):
-                        threads[coro] = Delegated(event.spawned)  # Suspend.
-                        threads[event.spawned] = ValueEvent(None)  # Spawn.
-                        history[event.spawned] = None  # Record in history.
-                        delegators[event.spawned] = coro
-                        have_ready = True
-                    elif isinstance(event, ReturnEvent):
-                        # Thread is done.
-                        complete_thread(coro, event.value)
-                        have_ready = True
-                    elif isinstance(event, JoinEvent):
-                        if event.child not in threads and event.child in history:
-                            threads[coro] = ValueEvent(None)
-                        else:
-                            threads[coro] = SUSPENDED  # Suspend.
-                            joiners[event.child].append(coro)
-                        have_ready = True
-                    elif isinstance(event, KillEvent):
-                        threads[coro] = ValueEvent(None)
-                        kill_thread(event.child)
-                        have_ready = True
-
-                # Only start the select when nothing else is ready.
-                if not have_ready:
-                    break
+            value = event.fire()
+        except socket.error as exc:
+            if isinstance(exc.args, tuple) and exc.args[0] in _WOULDBLOCK:
+                value = PENDING
+            else:
+                value = None
+        if value is PENDING:
+            self.registry.add(event, None)
+
+    def uncork(self):
+        """Send the data coalesced by threads during this pass. Any
+        data the sockets don't accept right away is sent in the
+        background once they become writable.
+        """
+        for conn in self.corked:
+            if conn._closed:
+                continue  # Already handed over by close().
+            try:
+                flushed = conn._flush()
+            except socket.error:
+                # The connection is broken. The next operation on it
+                # in its thread will fail.
+                flushed = True
+            if not flushed:
+                self.drain(conn)
+            elif conn._drain not in self.registry:
+                conn._drain.scheduler = None
+        self.corked.clear()
+
+    def drain(self, conn):
+        """Send a connection's queued data in the background as the
+        socket accepts it.
+        """
+        drain = conn._drain
+        drain.scheduler = self
+        if drain not in self.registry:
+            self.registry.add(drain, None)
+
+    def linger(self, conn):
+        """Finish sending a closed connection's queued data in the
+        background, then close its socket. The data is dropped if it
+        takes longer than the connection's LINGER time.
+        """
+        self.drain(conn)
+        conn._drain.timer = self.timers.add(_now() + conn.LINGER,
+                                            self.undrain, conn)
 
-            # Wait and fire.
-            event2coro = dict((v,k) for k,v in threads.items())
-            for event in _event_select(threads.values()):
-                # Run the IO operation, but catch socket errors.
-                try:
-                    value = event.fire()
-                except socket.error as exc:
-                    if isinstance(exc.args, tuple) and \
-                            exc.args[0] == errno.EPIPE:
-                        # Broken pipe. Remote host disconnected.
-                        pass
-                    elif isinstance(exc.args, tuple) and \
-                            exc.args[0] == errno.ECONNRESET:
-                        # Connection was reset by peer.
-                        pass
-                    else:
-                        traceback.print_exc()
-                    # Abort the coroutine.
-                    threads[event2coro[event]] = ReturnEvent(None)
-                else:
-                    advance_thread(event2coro[event], value)
+    def undrain_all(self):
+        """Stop sending queued data in the background for all
+        connections, closing the ones that have been closed.
+        """
+        for event in list(self.registry.events):
+            if isinstance(event, _DrainEvent):
+                self.undrain(event.conn)
 
-        except ThreadException as te:
-            # Exception raised from inside a thread.
-            event = ExceptionEvent(te.exc_info)
-            if te.coro in delegators:
-                # The thread is a delegate. Raise exception in its
-                # delegator.
-                threads[delegators[te.coro]] = event
-                del delegators[te.coro]
+    def undrain(self, conn):
+        """Stop sending a connection's queued data in the background.
+        If the connection has been closed, its socket is closed now.
+        """
+        drain = conn._drain
+        if drain in self.registry:
+            self.registry.remove(drain)
+        if drain.timer:
+            self.timers.cancel(drain.timer)
+            drain.timer = None
+        drain.scheduler = None
+        if conn._closed:
+            conn._wqueue.clear()
+            conn.sock.close()
+
+    def run_ready(self):
+        """Advance every thread that was ready when called. Threads that
+        become ready in the meantime wait for the next call, so I/O is
+        polled regularly even when threads yield continuously.
+        """
+        ready = self.ready
+        threads = self.threads
+        for _ in range(len(ready)):
+            coro, value, is_exc = ready.popleft()
+            if coro in threads:  # Not killed in the meantime.
+                self.advance(coro, value, is_exc)
+
+    def step(self, block=True):
+        """Make one pass through the main loop: advance the ready
+        threads, then fire the events and timers that are due. Unless
+        block is false, wait for I/O or the next timer first if no
+        thread is ready. Returns whether any threads remain.
+        """
+        try:
+            self.run_ready()
+            if self.corked:
+                self.uncork()
+            if not self.threads:
+                return False
+
+            # Wait for I/O or the next timer, unless some threads are
+            # already runnable.
+            if self.ready or not block:
+                timeout = 0.0
             else:
-                # The thread is root-level. Raise in client code.
-                exit_te = te
-                break
+                timeout = self.timers.timeout()
+            for coro, event in self.registry.poll(timeout):
+                if coro is None:
+                    self.fire_detached(event)
+                elif self.threads.get(coro) is event:
+                    self.fire(coro, event)
+
+            # Fire expired timers.
+            for func, args in self.timers.expire():
+                func(*args)
+
+        except ThreadException as te:
+            # Exception raised from inside a thread. If other threads
+            # are joining it, it has been raised in them.
+            if not self.fail_thread(te.coro, te.exc_info):
+                self.unhandled(te)
 
         except:
-            # For instance, KeyboardInterrupt during select(). Raise
-            # into root thread and terminate others.
-            threads = {root_coro: ExceptionEvent(sys.exc_info())}
+            # For instance, KeyboardInterrupt during select().
+            self.interrupt(sys.exc_info())
+
+        return bool(self.threads)
+
+    def unhandled(self, te):
+        """Deal with an exception raised by a thread that no other
+        thread is joining: end the run, raising it in client code.
+        """
+        self.exit_te = te
+
+    def interrupt(self, exc_info):
+        """Deal with an exception raised outside of the threads: raise
+        it into the root thread and terminate the others.
+        """
+        self.reset()
+        self.resume(self.root_coro, exc_info, True)
+
+    def reset(self):
+        """Forget all threads and everything they are waiting for."""
+        self.threads = {}
+        self.ready.clear()
+        self.corked.clear()
+        self.undrain_all()
+        self.registry.clear()
+        if self.waker:
+            self.registry.add(self.waker.event, None)
+        self.timers = _Timers()
+        self.sleepers.clear()
+        self.deadlines.clear()
+        self.stacks.clear()
+        self.calls.clear()
+        self.overdue.clear()
+        self.joiners.clear()
+
+    def close(self):
+        """Kill any remaining threads and release the scheduler's
+        resources.
+        """
+        for coro in list(self.threads):
+            for frame in reversed(self.stacks.get(coro, [coro])):
+                frame.close()
+        self.threads = {}
+        self.undrain_all()
+        self.registry.clear()
+        self.registry.backend.close()
+        if self.waker:
+            self.waker.close()
+            self.waker = None
+
+    def finish_drains(self):
+        """Once the threads are done, keep sending the data queued on
+        connections in the background until it has all gone out or the
+        connections' LINGER time runs out.
+        """
+        for event in list(self.registry.events):
+            if isinstance(event, _DrainEvent) and not event.timer:
+                event.timer = self.timers.add(_now() + event.conn.LINGER,
+                                              self.undrain, event.conn)
+        while any(isinstance(event, _DrainEvent)
+                  for event in self.registry.events):
+            for coro, event in self.registry.poll(self.timers.timeout()):
+                if coro is None:
+                    self.fire_detached(event)
+            for func, args in self.timers.expire():
+                func(*args)
+
+    def run(self):
+        """Run threads until the root thread exits, then finish sending
+        data queued in the background.
+        """
+        while self.step() and not self.exit_te:
+            pass
+        try:
+            if not self.exit_te:
+                self.finish_drains()
+        finally:
+            self.close()
+
+        # If we're exiting with an exception, raise it in the client.
+        if self.exit_te:
+            self.exit_te.reraise()
 
-    # If any threads still remain, kill them.
-    for coro in threads:
-        coro.close()
+def run(root_coro, backend=None):
+    """Schedules a coroutine, running it to completion. This
+    encapsulates the Bluelet scheduler, which the root coroutine can
+    add to by spawning new coroutines. The coroutine may be a generator
+    or a native (async def) coroutine.
 
-    # If we're exiting with an exception, raise it in the client.
-    if exit_te:
-        exit_te.reraise()
+    `backend` selects how the scheduler waits for I/O: one of the names
+    in `BACKENDS` ("select", "poll" or "epoll") or a backend object. By
+    default, the most scalable backend available on the platform is
+    used (epoll on Linux).
+    """
+    _Scheduler(root_coro, backend).run()
 
 
 # Sockets and their associated events.
@@ -392,28 +1486,64 @@ def run(root_coro):
 class SocketClosedError(Exception):
     pass
 
+def _byte_view(buffer):
+    """Get a memoryview of a buffer with one-byte items, so that
+    lengths and slices are in bytes.
+    """
+    view = memoryview(buffer)
+    if view.itemsize != 1 and hasattr(view, 'cast'):
+        view = view.cast('B')
+    return view
+
 class Listener(object):
     """A socket wrapper object for listening sockets.
     """
-    def __init__(self, host, port):
+    # The default number of connections accepted at once by
+    # accept_many().
+    ACCEPT_BATCH = 64
+
+    def __init__(self, host, port, reuse_port=False, backlog=None):
         """Create a listening socket on the given hostname and port.
+        With reuse_port, several processes can each have their own
+        listening socket on the same port (using SO_REUSEPORT), and the
+        kernel spreads incoming connections among them. backlog is the
+        number of connections the kernel queues before they are
+        accepted (by default, the system's maximum).
         """
         self._closed = False
         self.host = host
         self.port = port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.bind((host, port))
-        self.sock.listen(5)
+        if backlog is None:
+            backlog = socket.SOMAXCONN
+        self.sock.listen(backlog)
+        self.sock.setblocking(False)
 
-    def accept(self):
+    def accept(self, timeout=None):
         """An event that waits for a connection on the listening socket.
         When a connection is made, the event returns a Connection
-        object.
+        object. If timeout is given, Timeout is raised when no
+        connection arrives within that many seconds.
         """
         if self._closed:
             raise SocketClosedError()
-        return AcceptEvent(self)
+        return with_timeout(AcceptEvent(self), timeout)
+
+    def accept_many(self, limit=None, timeout=None):
+        """An event that waits for connections on the listening socket
+        and returns a list of Connection objects: all of those waiting
+        to be accepted, up to limit (by default, ACCEPT_BATCH). This
+        takes one wakeup for a burst of connections rather than one for
+        each.
+        """
+        if self._closed:
+            raise SocketClosedError()
+        return with_timeout(AcceptEvent(self, limit or self.ACCEPT_BATCH),
+                            timeout)
 
     def close(self):
         """Immediately close the listening socket. (Not an event.)
@@ -424,77 +1554,330 @@ class Listener(object):
 class Connection(object):
     """A socket wrapper object for connected sockets.
     """
-    def __init__(self, sock, addr):
+    # Bounds on the amount of data requested from the socket at once
+    # when reading lines. The request size doubles whenever a read
+    # fills it, so long lines take few reads.
+    MAX_CHUNK = 65536
+
+    # The default limit on coalesced, unsent data (see `coalesce`).
+    COALESCE_LIMIT = 65536
+
+    # How long, in seconds, a closed connection's unsent data may take
+    # to go out before it is dropped (see close()).
+    LINGER = 30.0
+
+    def __init__(self, sock, addr, coalesce=False):
         self.sock = sock
+        self.sock.setblocking(False)
         self.addr = addr
-        self._buf = b''
+
+        # In coalescing mode, sendall() doesn't wait for its data to be
+        # sent. Instead, the writes made by threads are gathered and
+        # sent together at the end of the scheduler's pass through its
+        # ready threads (i.e., once they all block), which saves system
+        # calls and packets for chatty protocols. sendall() only waits
+        # when more than coalesce_limit bytes are pending.
+        self.coalesce = coalesce
+        self.coalesce_limit = self.COALESCE_LIMIT
+        self._buf = bytearray()  # Data read but not yet consumed.
+        self._chunk = None  # Current read size for readline().
         self._closed = False
 
+        # Outgoing data not yet accepted by the kernel, as a queue of
+        # memoryviews, and running totals of the bytes queued and sent.
+        self._wqueue = collections.deque()
+        self._wqueued = 0
+        self._wsent = 0
+        self._drain = _DrainEvent(self)
+
     def close(self):
-        """Close the connection."""
+        """Close the connection. This never blocks: coalesced data that
+        has not been sent yet is sent in the background by the
+        scheduler, for up to LINGER seconds, and the socket is closed
+        after that.
+        """
+        if self._closed:
+            return
         self._closed = True
-        self.sock.close()
+        scheduler = self._drain.scheduler
+        if self._wqueue:
+            try:
+                flushed = self._flush()
+            except socket.error:
+                flushed = True
+            if not flushed and scheduler is not None:
+                scheduler.linger(self)
+                return
+            self._wqueue.clear()
+        if scheduler is not None:
+            scheduler.undrain(self)
+        else:
+            self.sock.close()
 
-    def recv(self, size):
-        """Read at most size bytes of data from the socket."""
+    def recv(self, size, timeout=None):
+        """Read at most size bytes of data from the socket. If timeout
+        is given, Timeout is raised when no data arrives within that
+        many seconds.
+        """
         if self._closed:
             raise SocketClosedError()
 
         if self._buf:
-            # We already have data read previously.
-            out = self._buf[:size]
-            self._buf = self._buf[size:]
+            # We already have data read previously. Deleting from the
+            # front of a bytearray doesn't copy the rest.
+            out = bytes(self._buf[:size])
+            del self._buf[:size]
             return ValueEvent(out)
         else:
-            return ReceiveEvent(self, size)
+            return with_timeout(ReceiveEvent(self, size), timeout)
+
+    def recv_into(self, buffer, nbytes=0, timeout=None):
+        """Read at most nbytes bytes (or, if nbytes is 0, enough to fill
+        the buffer) from the socket directly into a writable buffer
+        such as a bytearray or memoryview. Returns the number of bytes
+        read, which is 0 at the end of the stream. This avoids
+        allocating a new bytes object for every read.
+        """
+        if self._closed:
+            raise SocketClosedError()
+
+        view = _byte_view(buffer)
+        if not 0 <= nbytes <= len(view):
+            raise ValueError('nbytes is negative or larger than the buffer')
+        if self._buf:
+            # Copy out data read previously.
+            size = min(nbytes or len(view), len(self._buf))
+            src = memoryview(self._buf)
+            view[:size] = src[:size]
+            del src  # Unlock the buffer for resizing.
+            del self._buf[:size]
+            return ValueEvent(size)
+        else:
+            return with_timeout(ReceiveIntoEvent(self, view, nbytes),
+                                timeout)
 
-    def send(self, data):
+    def readexactly_into(self, buffer, timeout=None):
+        """Fill a writable buffer (such as a bytearray or memoryview)
+        with data from the socket, reading until the buffer is full or
+        the connection closes. Returns the number of bytes read.
+        """
+        if self._closed:
+            raise SocketClosedError()
+        return with_timeout(self._readexactly_into(_byte_view(buffer)),
+                            timeout)
+
+    def _readexactly_into(self, view):
+        got = 0
+        while got < len(view):
+            size = yield self.recv_into(view[got:])
+            if not size:
+                break
+            got += size
+        yield ReturnEvent(got)
+
+    def send(self, data, timeout=None):
         """Sends data on the socket, returning the number of bytes
         successfully sent.
         """
         if self._closed:
             raise SocketClosedError()
-        return SendEvent(self, data)
+        return with_timeout(SendEvent(self, data), timeout)
+
+    def sendall(self, data, timeout=None):
+        """Send all of data on the socket. The data is queued on the
+        connection when sendall() is called (not when the event is
+        yielded, so yield it right away) and written as the socket
+        accepts it, so a slow peer only blocks this thread; the event
+        completes once all of it has been handed to the kernel. If the
+        thread stops waiting (because of a timeout, say), the scheduler
+        sends the rest in the background.
+        """
+        if self._closed:
+            raise SocketClosedError()
+        return with_timeout(self._sendall_event([data]), timeout)
 
-    def sendall(self, data):
-        """Send all of data on the socket."""
+    def send_many(self, buffers, timeout=None):
+        """Like send, but sends a sequence of buffers with a single
+        scatter/gather system call where the platform supports it.
+        Returns the total number of bytes sent.
+        """
         if self._closed:
             raise SocketClosedError()
-        return SendEvent(self, data, True)
+        return with_timeout(SendEvent(self, list(buffers)), timeout)
 
-    def readline(self, terminator=b"\n", bufsize=1024):
-        """Reads a line (delimited by terminator) from the socket."""
+    def sendall_many(self, buffers, timeout=None):
+        """Like sendall, but sends a sequence of buffers (e.g., headers
+        and a body) in order without concatenating them. The buffers
+        are handed to the kernel together in as few system calls as
+        possible.
+        """
+        if self._closed:
+            raise SocketClosedError()
+        return with_timeout(self._sendall_event(list(buffers)), timeout)
+
+    def _sendall_event(self, buffers):
+        event = SendEvent(self, buffers, True)
+        if self.coalesce and \
+                self._wqueued - self._wsent <= self.coalesce_limit:
+            return CoalescedSendEvent(self)
+        return event
+
+    def sendfile(self, fileobj, offset=0, count=None, timeout=None):
+        """Send the contents of a file opened in binary mode, starting
+        at offset and continuing for count bytes (or to the end of the
+        file). Returns the number of bytes sent and leaves the file
+        positioned after the last byte sent.
+
+        For regular files, this uses os.sendfile() where possible to
+        have the kernel copy the data to the socket without passing it
+        through Python. Otherwise, the file is read and sent in chunks
+        so that memory use doesn't grow with the size of the file. A
+        stream that can't seek (such as a pipe) is read from where it
+        is, so offset must be 0.
+        """
         if self._closed:
             raise SocketClosedError()
+        return with_timeout(self._sendfile(fileobj, offset, count), timeout)
+
+    def _sendfile(self, fileobj, offset, count):
+        sent = None
+        if hasattr(os, 'sendfile'):
+            try:
+                fd = fileobj.fileno()
+            except (AttributeError, ValueError, IOError, OSError):
+                # Not backed by a real file (e.g., BytesIO).
+                fd = None
+            if fd is not None:
+                st = os.fstat(fd)
+                if stat.S_ISREG(st.st_mode):
+                    if count is None:
+                        count = max(st.st_size - offset, 0)
+                    sent = yield SendfileEvent(self, fd, offset, count)
+
+        if sent is None:
+            # Fall back to reading and sending chunks.
+            if offset or _seekable(fileobj):
+                fileobj.seek(offset)
+            sent = 0
+            while count is None or sent < count:
+                size = self.MAX_CHUNK
+                if count is not None:
+                    size = min(size, count - sent)
+                data = fileobj.read(size)
+                if not data:
+                    break
+                yield self.sendall(data)
+                sent += len(data)
+        else:
+            fileobj.seek(offset + sent)
+
+        yield ReturnEvent(sent)
+
+    def _queue(self, buffers):
+        """Add a sequence of buffers to the outgoing queue without
+        copying them. Returns the total number of bytes that will have
+        been sent once this data is out.
+        """
+        for data in buffers:
+            view = _byte_view(data)
+            if len(view):
+                self._wqueue.append(view)
+                self._wqueued += len(view)
+        return self._wqueued
+
+    def _flush(self):
+        """Send as much queued data as the socket accepts without
+        blocking, passing several buffers to each system call when
+        possible. Returns True if the queue is now empty.
+        """
+        queue = self._wqueue
+        while queue:
+            try:
+                if len(queue) > 1 and hasattr(self.sock, 'sendmsg'):
+                    views = list(itertools.islice(queue, _IOV_MAX))
+                    sent = self.sock.sendmsg(views)
+                else:
+                    views = (queue[0],)
+                    sent = self.sock.send(queue[0])
+            except socket.error as exc:
+                if exc.args[0] in _WOULDBLOCK:
+                    return False
+                raise
+            self._wsent += sent
+
+            # Drop the buffers that went out completely.
+            for view in views:
+                if sent < len(view):
+                    # The kernel's buffer is full.
+                    queue[0] = view[sent:]
+                    return False
+                sent -= len(view)
+                queue.popleft()
+        return True
+
+    def readline(self, terminator=b"\n", bufsize=1024, timeout=None):
+        """Reads a line (delimited by terminator) from the socket. If
+        timeout is given, Timeout is raised when the whole line does
+        not arrive within that many seconds.
+        """
+        if self._closed:
+            raise SocketClosedError()
+        return with_timeout(self._readline(terminator, bufsize), timeout)
 
+    def _readline(self, terminator, bufsize):
+        buf = self._buf
+        chunk = max(self._chunk or bufsize, bufsize)
+        start = 0  # Everything before this has been searched already.
         while True:
-            if terminator in self._buf:
-                line, self._buf = self._buf.split(terminator, 1)
-                line += terminator
+            pos = buf.find(terminator, start)
+            if pos != -1:
+                end = pos + len(terminator)
+                line = bytes(buf[:end])
+                del buf[:end]
+                self._chunk = chunk
                 yield ReturnEvent(line)
                 break
-            data = yield ReceiveEvent(self, bufsize)
+            start = max(len(buf) - len(terminator) + 1, 0)
+
+            data = yield ReceiveEvent(self, chunk)
             if data:
-                self._buf += data
+                buf += data
+                if len(data) == chunk:
+                    chunk = min(chunk * 2, max(self.MAX_CHUNK, bufsize))
             else:
-                line = self._buf
-                self._buf = b''
+                line = bytes(buf)
+                del buf[:]
                 yield ReturnEvent(line)
                 break
 
 class AcceptEvent(WaitableEvent):
     """An event for Listener objects (listening sockets) that suspends
-    execution until the socket gets a connection.
+    execution until the socket gets a connection. If a limit is given,
+    up to that many waiting connections are accepted and returned as a
+    list.
     """
-    def __init__(self, listener):
+    def __init__(self, listener, limit=None):
         self.listener = listener
+        self.limit = limit
 
     def waitables(self):
         return (self.listener.sock,), (), ()
 
     def fire(self):
         sock, addr = self.listener.sock.accept()
-        return Connection(sock, addr)
+        if self.limit is None:
+            return Connection(sock, addr)
+
+        conns = [Connection(sock, addr)]
+        while len(conns) < self.limit:
+            try:
+                sock, addr = self.listener.sock.accept()
+            except socket.error:
+                # Usually EAGAIN: no more connections waiting. Other
+                # errors show up again on the next accept.
+                break
+            conns.append(Connection(sock, addr))
+        return conns
 
 class ReceiveEvent(WaitableEvent):
     """An event for Connection objects (connected sockets) for
@@ -510,23 +1893,178 @@ class ReceiveEvent(WaitableEvent):
     def fire(self):
         return self.conn.sock.recv(self.bufsize)
 
+class ReceiveIntoEvent(WaitableEvent):
+    """An event for Connection objects (connected sockets) for
+    asynchronously reading data into an existing buffer.
+    """
+    def __init__(self, conn, buffer, nbytes=0):
+        self.conn = conn
+        self.buffer = buffer
+        self.nbytes = nbytes
+
+    def waitables(self):
+        return (self.conn.sock,), (), ()
+
+    def fire(self):
+        return self.conn.sock.recv_into(self.buffer, self.nbytes)
+
 class SendEvent(WaitableEvent):
     """An event for Connection objects (connected sockets) for
-    asynchronously writing data.
+    asynchronously writing data. With sendall, the data is added to the
+    connection's outgoing queue when the event is created, and the
+    event completes once it has all been sent; otherwise, the event
+    sends what it can (after any queued data) and returns the number of
+    bytes sent.
     """
     def __init__(self, conn, data, sendall=False):
         self.conn = conn
         self.data = data
         self.sendall = sendall
+        if sendall:
+            if isinstance(data, list):
+                self.target = conn._queue(data)
+            else:
+                self.target = conn._queue((data,))
 
     def waitables(self):
         return (), (self.conn.sock,), ()
 
     def fire(self):
+        flushed = self.conn._flush()
         if self.sendall:
-            return self.conn.sock.sendall(self.data)
-        else:
-            return self.conn.sock.send(self.data)
+            if self.conn._wsent >= self.target:
+                return None
+        elif flushed:
+            if not isinstance(self.data, list):
+                return self.conn.sock.send(self.data)
+            elif hasattr(self.conn.sock, 'sendmsg'):
+                return self.conn.sock.sendmsg(self.data[:_IOV_MAX])
+            elif self.data:
+                return self.conn.sock.send(self.data[0])
+            else:
+                return 0
+        return PENDING
+
+
+class ConnectEvent(WaitableEvent):
+    """An event that waits for one of several non-blocking connection
+    attempts to finish. Returns a pair: the connected socket (or None)
+    and a list of (socket, errno) pairs for failed attempts.
+    """
+    def __init__(self, socks):
+        self.socks = socks
+
+    def waitables(self):
+        return (), self.socks, ()
+
+    def fire(self):
+        failed = []
+        for sock in self.socks:
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                failed.append((sock, err))
+                continue
+            try:
+                sock.getpeername()
+            except socket.error:
+                continue  # Still connecting.
+            return sock, failed
+        if failed:
+            return None, failed
+        return PENDING
+
+class SendfileEvent(WaitableEvent):
+    """An event for Connection objects (connected sockets) that sends
+    part of a file using os.sendfile(), returning the number of bytes
+    sent. If the kernel can't send this file to this socket, the event
+    returns None without sending anything.
+    """
+    def __init__(self, conn, fd, offset, count):
+        self.conn = conn
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+        self.sent = 0
+
+    def waitables(self):
+        return (), (self.conn.sock,), ()
+
+    def fire(self):
+        if not self.conn._flush():
+            return PENDING
+        while self.sent < self.count:
+            try:
+                sent = os.sendfile(self.conn.sock.fileno(), self.fd,
+                                   self.offset + self.sent,
+                                   self.count - self.sent)
+            except OSError as exc:
+                if exc.errno in _WOULDBLOCK:
+                    return PENDING
+                elif self.sent == 0 and exc.errno in _NO_SENDFILE:
+                    return None
+                raise
+            if not sent:
+                break  # End of file.
+            self.sent += sent
+        return self.sent
+
+# The most buffers that can be passed to one sendmsg() call.
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
+if _IOV_MAX <= 0:
+    _IOV_MAX = 16
+
+class CoalescedSendEvent(Event):
+    """Returned by sendall() on a connection in coalescing mode. The
+    data is already queued; this event lets the thread continue and
+    tells the scheduler to send the connection's queued data at the
+    end of its current pass.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+def _seekable(fileobj):
+    """Check whether a file object supports seeking."""
+    try:
+        return fileobj.seekable()
+    except AttributeError:
+        # Python 2 file objects don't say.
+        try:
+            fileobj.tell()
+        except (IOError, OSError):
+            return False
+        return True
+
+class _DrainEvent(WaitableEvent):
+    """Sends a connection's queued data in the background once the
+    socket is writable. Used for data that no thread waits for, such as
+    coalesced writes. The scheduler doing this, if any, is recorded so
+    that closing the connection can hand its remaining data over.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.scheduler = None
+        self.timer = None  # Gives up on a closed connection's data.
+
+    def waitables(self):
+        return (), (self.conn.sock,), ()
+
+    def fire(self):
+        try:
+            if not self.conn._flush():
+                return PENDING
+        except socket.error:
+            pass  # The connection is broken; give up on the data.
+        self.scheduler.undrain(self.conn)
+        return None
+
+# Errors from os.sendfile() indicating that it doesn't support a
+# particular kind of file or socket.
+_NO_SENDFILE = frozenset(getattr(errno, name) for name in
+                         ('EINVAL', 'ENOSYS', 'ENOTSOCK', 'EOPNOTSUPP',
+                          'ENOTSUP', 'EBADF') if hasattr(errno, name))
 
 
 # Public interface for threads; each returns an event object that
@@ -539,18 +2077,20 @@ def null():
 
 def spawn(coro):
     """Event: add another coroutine to the scheduler. Both the parent
-    and child coroutines run concurrently.
+    and child coroutines run concurrently. Returns a Task for the new
+    thread.
     """
-    if not isinstance(coro, types.GeneratorType):
+    if not isinstance(coro, _COROUTINE_TYPES):
         raise ValueError('%s is not a coroutine' % str(coro))
     return SpawnEvent(coro)
 
 def call(coro):
     """Event: delegate to another coroutine. The current coroutine
     is resumed once the sub-coroutine finishes. If the sub-coroutine
-    returns a value using end(), then this event returns that value.
+    returns a value using end() (or, on Python 3, a return statement),
+    then this event returns that value.
     """
-    if not isinstance(coro, types.GeneratorType):
+    if not isinstance(coro, _COROUTINE_TYPES):
         raise ValueError('%s is not a coroutine' % str(coro))
     return DelegationEvent(coro)
 
@@ -581,30 +2121,1154 @@ def write(fd, data):
     """Event: write to a file descriptor asynchronously."""
     return WriteEvent(fd, data)
 
-def connect(host, port):
+def connect(host, port, timeout=None, happy_eyeballs_delay=None):
     """Event: connect to a network address and return a Connection
-    object for communicating on the socket.
+    object for communicating on the socket. If timeout is given,
+    Timeout is raised when the connection cannot be established within
+    that many seconds.
+
+    Host names are resolved on a background thread and connections are
+    made without blocking, so other threads keep running meanwhile.
+    The addresses a name resolves to are tried in turn. If
+    happy_eyeballs_delay is given, the next address is tried after that
+    many seconds even if the previous attempt is still in progress, and
+    the first to succeed wins (RFC 8305).
+    """
+    return with_timeout(_connect(host, port, happy_eyeballs_delay), timeout)
+
+def _connect(host, port, delay):
+    infos = list((yield resolve(host, port)))
+    if delay is not None:
+        infos = _interleave_families(infos)
+
+    pending = {}  # Sockets with connections in progress.
+    errors = []
+    try:
+        while infos or pending:
+            if infos:
+                family, type_, proto, _, addr = infos.pop(0)
+                sock = socket.socket(family, type_, proto)
+                sock.setblocking(False)
+                err = sock.connect_ex(addr)
+                if not err:
+                    sock = pending.pop(sock, sock)
+                    yield ReturnEvent(Connection(sock, (host, port)))
+                    return
+                elif err in _CONNECTING:
+                    pending[sock] = addr
+                else:
+                    sock.close()
+                    errors.append(socket.error(err, os.strerror(err)))
+                    continue
+
+            # Wait for an attempt to finish, or until it's time to
+            # start another.
+            event = ConnectEvent(list(pending))
+            if infos and delay is not None:
+                event = with_timeout(event, delay)
+            try:
+                connected, failed = yield event
+            except Timeout:
+                continue
+
+            for sock, err in failed:
+                del pending[sock]
+                sock.close()
+                errors.append(socket.error(err, os.strerror(err)))
+            if connected:
+                del pending[connected]
+                yield ReturnEvent(Connection(connected, (host, port)))
+                return
+    finally:
+        for sock in pending:
+            sock.close()
+
+    if errors:
+        raise errors[-1]
+    raise socket.error('getaddrinfo returned an empty list')
+
+def _interleave_families(infos):
+    """Reorder addresses to alternate between address families, as
+    recommended for Happy Eyeballs.
+    """
+    by_family = collections.OrderedDict()
+    for info in infos:
+        by_family.setdefault(info[0], []).append(info)
+    out = []
+    for group in _zip_longest(*by_family.values()):
+        out += [info for info in group if info is not None]
+    return out
+
+_zip_longest = getattr(itertools, 'zip_longest', None) or \
+    getattr(itertools, 'izip_longest')
+
+# connect_ex() results indicating that the connection is in progress.
+_CONNECTING = frozenset((errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN))
+
+# The number of threads used to resolve host names.
+RESOLVER_THREADS = 8
+
+_lookup_pool = None
+
+def _resolver_pool():
+    global _lookup_pool
+    if _lookup_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _lookup_pool = ThreadPoolExecutor(RESOLVER_THREADS)
+    return _lookup_pool
+
+class Resolver(object):
+    """Caches the results of host name lookups. Entries expire after
+    ``ttl`` seconds and, beyond ``maxsize`` entries, the least recently
+    used entry is evicted. Concurrent lookups for the same name share a
+    single resolution.
+
+    ``hits`` counts lookups answered from the cache (or by joining a
+    resolution already in progress) and ``misses`` counts lookups that
+    had to call getaddrinfo.
+    """
+    def __init__(self, ttl=60.0, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()  # key -> (expiry, infos)
+        self._inflight = {}  # key -> future
+        # Lookups finish on the resolver threads.
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Event: look up a host name, returning a list of address
+        tuples for TCP connections.
+        """
+        key = (host, port)
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None and entry[0] > _now():
+                self._cache[key] = entry  # Most recently used.
+                self.hits += 1
+                return ValueEvent(list(entry[1]))
+
+            future = self._inflight.get(key)
+            if future is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                future = _resolver_pool().submit(self._lookup, key)
+                self._inflight[key] = future
+        return FutureEvent(future)
+
+    def _lookup(self, key):
+        try:
+            infos = socket.getaddrinfo(key[0], key[1], 0, socket.SOCK_STREAM)
+        except BaseException:
+            with self._lock:
+                del self._inflight[key]
+            raise
+        with self._lock:
+            del self._inflight[key]
+            if self.ttl > 0 and self.maxsize > 0:
+                self._cache[key] = (_now() + self.ttl, tuple(infos))
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        return infos
+
+    def clear(self):
+        """Drop all cached entries."""
+        with self._lock:
+            self._cache.clear()
+
+# The cache used by resolve() and connect().
+resolver = Resolver()
+
+def resolve(host, port):
+    """Event: look up a host name (on a background thread, so the
+    scheduler isn't blocked) and return a list of address tuples for
+    TCP connections, as returned by socket.getaddrinfo(). Results are
+    cached by `resolver`.
     """
-    addr = (host, port)
-    sock = socket.create_connection(addr)
-    return ValueEvent(Connection(sock, addr))
+    try:
+        # Numeric addresses don't need a lookup.
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM, 0,
+                                   socket.AI_NUMERICHOST)
+    except socket.gaierror:
+        pass
+    else:
+        return ValueEvent(infos)
+    return resolver.resolve(host, port)
+
+class ConnectionPool(object):
+    """Keeps outbound connections open for reuse, saving a handshake
+    per request. acquire() hands out an idle Connection to a (host,
+    port) if there is one and connects otherwise; release() gives it
+    back. At most max_per_host connections to each address are open at
+    once, in use or idle; beyond that, acquire() waits for a release.
+
+    Idle connections are closed once they have been idle for
+    idle_timeout seconds (None keeps them indefinitely); this is checked
+    whenever the pool is used, so the pool needs no thread of its own.
+    Ones the other end has closed meanwhile are discarded rather than
+    handed out. Call close() when done with the pool so idle
+    connections don't linger.
+    """
+    def __init__(self, max_per_host=8, idle_timeout=30.0,
+                 connect_timeout=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self._closed = False
+
+        # Idle connections by address, as (conn, expiry) pairs with the
+        # most recently released last; the number of open connections
+        # by address; threads waiting for a connection to an address;
+        # and the addresses of connections in use.
+        self._idle = {}
+        self._counts = {}
+        self._waiters = {}
+        self._keys = {}
+
+    def acquire(self, host, port, timeout=None):
+        """Event: get a Connection to host and port. If timeout is
+        given, Timeout is raised when none can be had within that many
+        seconds.
+        """
+        if self._closed:
+            raise SocketClosedError()
+        return with_timeout(self._acquire((host, port)), timeout)
+
+    def release(self, conn, reuse=True):
+        """Return a connection obtained from acquire(). Unless reuse is
+        False (say, when a response was not read completely), it is
+        kept for later requests. (Not an event.)
+        """
+        key = self._keys.pop(conn)
+        self._expire()
+        if not reuse or conn._closed or self._closed:
+            conn.close()
+            self._discard(key)
+        else:
+            # Rather than handing the connection to a waiting thread,
+            # which may time out or be killed before it runs, park it
+            # and let the waiter pick it up.
+            if self.idle_timeout is None:
+                expiry = float('inf')
+            else:
+                expiry = _now() + self.idle_timeout
+            self._idle.setdefault(key, []).append((conn, expiry))
+            self._wake(key)
+
+    def close(self):
+        """Close all idle connections. Connections in use are closed
+        when they are released. (Not an event.)
+        """
+        self._closed = True
+        for key, idle in list(self._idle.items()):
+            for conn, _ in idle:
+                conn.close()
+                self._discard(key)
+        self._idle.clear()
+
+    def _acquire(self, key):
+        self._expire()
+        while True:
+            conn = self._pop_idle(key)
+            if conn is not None:
+                break
+            if self._counts.get(key, 0) < self.max_per_host:
+                self._counts[key] = self._counts.get(key, 0) + 1
+                try:
+                    conn = yield connect(key[0], key[1],
+                                         self.connect_timeout)
+                except:
+                    self._discard(key)
+                    raise
+                break
+
+            # Wait for a connection to be released or for a slot to
+            # free up.
+            yield self._waiters.setdefault(key, _WaitQueue()).wait()
+
+        self._keys[conn] = key
+        yield ReturnEvent(conn)
+
+    def _pop_idle(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            conn, _ = idle.pop()
+            if self._usable(conn):
+                return conn
+            conn.close()
+            self._discard(key)
+        return None
+
+    @staticmethod
+    def _usable(conn):
+        """Check that an idle connection is still open and that nothing
+        unexpected has arrived on it.
+        """
+        if conn._closed or conn._buf:
+            return False
+        try:
+            conn.sock.recv(1, socket.MSG_PEEK)
+        except socket.error as exc:
+            return exc.args[0] in _WOULDBLOCK
+        return False  # Closed by the other end, or stray data.
+
+    def _wake(self, key):
+        waiters = self._waiters.get(key)
+        if waiters is not None:
+            waiters.wake()
+            if not waiters:
+                del self._waiters[key]
+
+    def _discard(self, key):
+        """Account for a closed connection, letting a waiting thread
+        open a new one.
+        """
+        self._counts[key] -= 1
+        if not self._counts[key]:
+            del self._counts[key]
+        self._wake(key)
+
+    def _expire(self):
+        """Close the connections that have been idle for too long."""
+        now = _now()
+        for key, idle in list(self._idle.items()):
+            while idle and idle[0][1] <= now:
+                idle.pop(0)[0].close()
+                self._discard(key)
+            if not idle:
+                del self._idle[key]
 
 def sleep(duration):
     """Event: suspend the thread for ``duration`` seconds.
     """
     return SleepEvent(duration)
 
-def join(coro):
+def join(coro, timeout=None):
     """Suspend the thread until another, previously `spawn`ed thread
-    completes.
+    (given as its coroutine or Task) completes, and return its result.
+    If the thread raised an exception, it is raised here as well, and
+    it then doesn't propagate out of `run`. If timeout is given, Timeout
+    is raised when the thread does not complete within that many
+    seconds.
     """
-    return JoinEvent(coro)
+    if isinstance(coro, Task):
+        if coro.done():
+            if coro._is_exc:
+                return ExceptionEvent(coro._value)
+            return ValueEvent(coro._value)
+        coro = coro.coro
+    return with_timeout(JoinEvent(coro), timeout)
 
 def kill(coro):
-    """Halt the execution of a different `spawn`ed thread.
+    """Halt the execution of a different `spawn`ed thread (given as its
+    coroutine or Task).
     """
+    if isinstance(coro, Task):
+        if coro.done():
+            return ValueEvent(None)
+        coro = coro.coro
     return KillEvent(coro)
 
+def gather(coros, limit=None):
+    """Event: run coroutines as concurrent threads and return a list of
+    their results, in order. With a limit, at most that many run at
+    once and the rest are started as others finish, so large numbers of
+    coroutines (which may come from an iterator) can be gathered
+    without all running at once. If one raises an exception, the
+    running ones are killed, no more are started, and the exception is
+    raised.
+    """
+    return DelegationEvent(_gather(_Completion(coros, limit)))
+
+def _gather(completion):
+    results = {}
+    while completion.running or completion.more():
+        index, value, is_exc = yield completion.wait()
+        if is_exc:
+            yield completion.kill()
+            _reraise(*value)
+        results[index] = value
+    yield ReturnEvent([results[i] for i in range(len(results))])
+
+def as_completed(coros, limit=None):
+    """Run coroutines as concurrent threads (at most limit at a time,
+    as with `gather`), and return an iterator of events that give their
+    results as they finish:
+
+        for event in bluelet.as_completed(coros, limit=10):
+            result = yield event
+
+    An event raises the exception if that coroutine raised one.
+    """
+    completion = _Completion(coros, limit)
+    while completion.running or completion.more():
+        yield DelegationEvent(_next_result(completion))
+
+def _next_result(completion):
+    index, value, is_exc = yield completion.wait()
+    if is_exc:
+        _reraise(*value)
+    yield ReturnEvent(value)
+
+class _Completion(object):
+    """Runs coroutines as threads, at most limit at a time, and reports
+    their outcomes as they finish. Each is run by a wrapper thread that
+    catches its exception, so it doesn't propagate out of run().
+    """
+    def __init__(self, coros, limit):
+        self.limit = limit
+        self.running = {}  # Index -> wrapper thread.
+        self._coros = enumerate(coros)
+        self._ahead = None  # The next (index, coroutine) to start.
+        self._finished = Queue()
+
+    def more(self):
+        """Return whether any coroutines have yet to be started."""
+        if self._ahead is None and self._coros is not None:
+            try:
+                self._ahead = next(self._coros)
+            except StopIteration:
+                self._coros = None
+        return self._ahead is not None
+
+    def wait(self):
+        """Event: start more threads, up to the limit, and then wait for
+        one to finish. Returns (index, value, is_exc).
+        """
+        return DelegationEvent(self._wait())
+
+    def _wait(self):
+        started = []
+        while self.more() and \
+                (not self.limit or len(self.running) < self.limit):
+            index, coro = self._ahead
+            self._ahead = None
+            if not isinstance(coro, _COROUTINE_TYPES):
+                raise ValueError('%s is not a coroutine' % str(coro))
+            self.running[index] = self._watch(index, coro)
+            started.append(self.running[index])
+        if started:
+            yield _SpawnManyEvent(started)
+
+        index, value, is_exc = yield self._finished.get()
+        del self.running[index]
+        yield ReturnEvent((index, value, is_exc))
+
+    def _watch(self, index, coro):
+        try:
+            value = yield coro
+        except Exception:
+            yield self._finished.put((index, sys.exc_info(), True))
+        else:
+            yield self._finished.put((index, value, False))
+
+    def kill(self):
+        """Event: kill the running threads."""
+        return DelegationEvent(self._kill())
+
+    def _kill(self):
+        for index, wrapper in list(self.running.items()):
+            del self.running[index]
+            yield kill(wrapper)
+
+
+def with_timeout(event, duration):
+    """Event: wait for another event, or run a sub-coroutine as with
+    `call`, but raise Timeout in the thread if it takes more than
+    ``duration`` seconds. Any sub-coroutine is killed when the time
+    runs out. A duration of None means no timeout.
+    """
+    if isinstance(event, _COROUTINE_TYPES):
+        event = DelegationEvent(event)
+    if duration is None:
+        return event
+    return TimeoutEvent(event, duration)
+
+
+
+# Synchronization and communication between threads. Waiting threads
+# are parked on wait queues and woken one at a time, in the order they
+# started waiting; no polling is involved.
+
+class Semaphore(object):
+    """A counter of available permits. acquire() takes one, waiting if
+    there are none, and release() returns one. Use it to cap how many
+    threads do something at once:
+
+        with (yield sem.acquire()):
+            ...
+    """
+    def __init__(self, value=1):
+        self._value = value
+        self._waiters = _WaitQueue()
+
+    def acquire(self, timeout=None):
+        """Event: take a permit, waiting for one to be released if
+        there are none. Returns the semaphore (for use with ``with``).
+        If timeout is given, Timeout is raised when no permit is
+        released within that many seconds.
+        """
+        if self._value > 0:
+            self._value -= 1
+            return ValueEvent(self)
+        return with_timeout(self._waiters.wait(), timeout)
+
+    def release(self):
+        """Return a permit, handing it to the longest-waiting thread if
+        there is one. (Not an event.)
+        """
+        if not self._waiters.wake(self):
+            self._value += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+class Lock(Semaphore):
+    """A mutual exclusion lock: a semaphore with a single permit that
+    may not be released while it isn't held.
+    """
+    def __init__(self):
+        Semaphore.__init__(self, 1)
+
+    def locked(self):
+        """Return whether the lock is held."""
+        return self._value == 0
+
+    def release(self):
+        """Release the lock. (Not an event.)"""
+        if self._value:
+            raise RuntimeError('release of unlocked lock')
+        Semaphore.release(self)
+
+class Flag(object):
+    """A flag that threads can wait to be set, like threading.Event.
+    (Bluelet's Event is the base class of the things threads yield.)
+    """
+    def __init__(self):
+        self._set = False
+        self._waiters = _WaitQueue()
+
+    def is_set(self):
+        return self._set
+
+    def set(self):
+        """Set the flag, waking every waiting thread. (Not an event.)
+        """
+        self._set = True
+        while self._waiters.wake(True):
+            pass
+
+    def clear(self):
+        """Unset the flag. (Not an event.)"""
+        self._set = False
+
+    def wait(self, timeout=None):
+        """Event: wait until the flag is set. If timeout is given,
+        Timeout is raised when it isn't set within that many seconds.
+        """
+        if self._set:
+            return ValueEvent(True)
+        return with_timeout(self._waiters.wait(), timeout)
+
+class Condition(object):
+    """A condition variable: threads holding the lock (a new Lock if
+    none is given) wait() for another thread to notify() them that the
+    state they care about may have changed.
+    """
+    def __init__(self, lock=None):
+        self.lock = lock or Lock()
+        self._waiters = _WaitQueue()
+
+    def acquire(self, timeout=None):
+        """Event: acquire the underlying lock."""
+        return self.lock.acquire(timeout)
+
+    def release(self):
+        """Release the underlying lock. (Not an event.)"""
+        self.lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+    def wait(self, timeout=None):
+        """Event: release the lock, wait to be notified, and then
+        acquire the lock again. If timeout is given, Timeout is raised
+        (with the lock held again) when no notification comes within
+        that many seconds.
+        """
+        return DelegationEvent(self._wait(timeout))
+
+    def _wait(self, timeout):
+        self.lock.release()
+        try:
+            yield with_timeout(self._waiters.wait(), timeout)
+        except Timeout:
+            yield self.lock.acquire()
+            raise
+        yield self.lock.acquire()
+
+    def notify(self, n=1):
+        """Wake up to n waiting threads. (Not an event.)"""
+        for _ in range(n):
+            if not self._waiters.wake():
+                break
+
+    def notify_all(self):
+        """Wake all waiting threads. (Not an event.)"""
+        while self._waiters.wake():
+            pass
+
+class Queue(object):
+    """A first-in, first-out queue for passing objects between threads.
+    If maxsize is greater than zero, the queue holds at most that many
+    items and put() waits while it is full, so producers can't get
+    ahead of consumers. Waiting threads are woken one at a time, in the
+    order they started waiting.
+    """
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._items = collections.deque()
+        self._getters = _WaitQueue()
+        self._putters = _WaitQueue()  # Each with the item to put.
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, timeout=None):
+        """Event: add an item to the queue, waiting for room if it is
+        full. If timeout is given, Timeout is raised (and the item is
+        not added) when no room is made within that many seconds.
+        """
+        if self._getters.wake(item):
+            # Handed straight to a waiting thread.
+            return ValueEvent(None)
+        if self.maxsize <= 0 or len(self._items) < self.maxsize:
+            self._items.append(item)
+            return ValueEvent(None)
+        return with_timeout(self._putters.wait(item), timeout)
+
+    def get(self, timeout=None):
+        """Event: remove and return the next item from the queue,
+        waiting for one if it is empty. If timeout is given, Timeout is
+        raised when no item arrives within that many seconds.
+        """
+        if self._items:
+            item = self._items.popleft()
+            putter = self._putters.wake()
+            if putter:
+                self._items.append(putter.value)
+            return ValueEvent(item)
+        return with_timeout(self._getters.wait(), timeout)
+
+
+# Running blocking code on other OS threads.
+
+# The default number of worker threads in an Executor.
+EXECUTOR_THREADS = 16
+
+class Executor(object):
+    """Runs blocking functions (file system calls, database drivers and
+    the like) on a bounded pool of OS threads so that they don't stall
+    the scheduler. The waiting thread is woken when the function
+    returns. Worker threads are started on first use.
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or EXECUTOR_THREADS
+        self._pool = None
+
+    def submit(self, func, *args, **kwargs):
+        """Start func(*args, **kwargs) on a worker thread and return a
+        concurrent.futures.Future for its result. (Not an event.)
+        """
+        if self._pool is None:
+            self._pool = self._make_pool()
+        return self._pool.submit(func, *args, **kwargs)
+
+    def run(self, func, *args, **kwargs):
+        """Event: call func(*args, **kwargs) on a worker thread and
+        return its result (or raise its exception).
+        """
+        return FutureEvent(self.submit(func, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        """Stop the workers once queued calls are done. (Not an
+        event.)
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait)
+            self._pool = None
+
+    def _make_pool(self):
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(self.max_workers)
+
+class ProcessExecutor(Executor):
+    """Like Executor, but runs functions in a pool of worker processes,
+    for CPU-bound work that would otherwise hold the GIL (and the
+    scheduler). Functions, arguments and results must be picklable.
+    max_workers defaults to the number of CPUs. If a worker process
+    dies, the pool is replaced for later calls.
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._pool = None
+
+    def submit(self, func, *args, **kwargs):
+        """Start func(*args, **kwargs) in a worker process and return a
+        concurrent.futures.Future for its result. (Not an event.)
+        """
+        try:
+            return Executor.submit(self, func, *args, **kwargs)
+        except RuntimeError:
+            # BrokenProcessPool (a RuntimeError) once a worker has
+            # died: start over with a new pool.
+            if not getattr(self._pool, '_broken', False):
+                raise
+            self._pool = None
+            return Executor.submit(self, func, *args, **kwargs)
+
+    def _make_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(self.max_workers)
+
+# The executors used by to_thread() and to_process().
+executor = Executor()
+process_executor = ProcessExecutor()
+
+def to_thread(func, *args, **kwargs):
+    """Event: call func(*args, **kwargs) on a worker thread of the
+    default `executor`, returning its result (or raising its
+    exception). Use this for blocking calls.
+    """
+    return executor.run(func, *args, **kwargs)
+
+def to_process(func, *args, **kwargs):
+    """Event: call func(*args, **kwargs) in a worker process of the
+    default `process_executor`, returning its result (or raising its
+    exception). Use this for CPU-heavy work.
+    """
+    return process_executor.run(func, *args, **kwargs)
+
+
+
+# Channels for sending Python objects between processes.
+
+# Pickle protocol 5 (Python 3.8) can pass large buffers (bytearrays,
+# NumPy arrays, ...) "out of band", so they can be sent without being
+# copied into the pickle.
+_PICKLE_OOB = pickle.HIGHEST_PROTOCOL >= 5
+
+# Messages that are bytes or bytearrays at least this large are sent
+# out of band too. (Pickle keeps them in band otherwise.)
+_OOB_MIN = 4096
+
+class _OutOfBand(object):
+    """Wraps a bytes or bytearray object to pickle it out of band."""
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        return _unpickle_bytes, (type(self.data),
+                                 pickle.PickleBuffer(self.data))
+
+def _unpickle_bytes(typ, buf):
+    # Out-of-band buffers are received as bytearrays.
+    return buf if type(buf) is typ else typ(buf)
+
+# A frame starts with the pickle's length and the number of out-of-band
+# buffers, followed by an entry for each buffer (whether it is in the
+# shared memory ring and its length), the pickle, and the buffers
+# that are not in the ring.
+_FRAME = struct.Struct('!II')
+_BUFFER = struct.Struct('!?Q')
+
+class _Ring(object):
+    """A ring buffer in shared memory carrying bytes from one process
+    to another. The segment is unlinked right away, so it lives exactly
+    as long as the processes (forked after its creation) using it. Two
+    counters at the start of the segment, bytes written and bytes read,
+    track the free space; the data itself is read in the order it was
+    written, as announced by frames on the channel's socket.
+    """
+    def __init__(self, size):
+        from multiprocessing import shared_memory
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=size + 16)
+        self.shm.unlink()
+
+    def _counter(self, index):
+        return struct.unpack_from('Q', self.shm.buf, index * 8)[0]
+
+    def write(self, view):
+        """Copy a byte memoryview into the ring if there's room.
+        Returns whether it was written.
+        """
+        size = len(view)
+        written = self._counter(0)
+        if size > self.size - (written - self._counter(1)):
+            return False
+        buf = self.shm.buf
+        pos = 16 + written % self.size
+        first = min(size, 16 + self.size - pos)
+        buf[pos:pos + first] = view[:first]
+        buf[16:16 + size - first] = view[first:]
+        struct.pack_into('Q', buf, 0, written + size)
+        return True
+
+    def read(self, size):
+        """Take the next size bytes out of the ring as a bytearray."""
+        buf = self.shm.buf
+        done = self._counter(1)
+        pos = 16 + done % self.size
+        first = min(size, 16 + self.size - pos)
+        out = bytearray(size)
+        out[:first] = buf[pos:pos + first]
+        out[first:] = buf[16:16 + size - first]
+        struct.pack_into('Q', buf, 8, done + size)
+        return out
+
+class Endpoint(object):
+    """One end of a `channel`, for sending picklable objects to the
+    other end. Messages are framed by their length, and with pickle
+    protocol 5, buffers such as bytearrays and arrays are sent without
+    being copied into the pickle. Large buffers go through the
+    channel's shared memory ring, if it has one and there is room.
+
+    Only one thread should get() from an endpoint at a time.
+    """
+    # Out-of-band buffers at least this large use the ring.
+    RING_THRESHOLD = 65536
+
+    def __init__(self, sock, outbox=None, inbox=None):
+        self.conn = Connection(sock, None)
+        self._outbox = outbox
+        self._inbox = inbox
+
+    def put(self, obj, timeout=None):
+        """Event: send an object to the other endpoint."""
+        buffers = []
+        if _PICKLE_OOB:
+            def out_of_band(buf):
+                try:
+                    buffers.append(buf.raw())
+                except BufferError:
+                    return True  # Not contiguous; keep it in the pickle.
+            if type(obj) in (bytes, bytearray) and len(obj) >= _OOB_MIN:
+                obj = _OutOfBand(obj)
+            payload = pickle.dumps(obj, 5, buffer_callback=out_of_band)
+        else:
+            payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+        entries = []
+        inline = []
+        for view in buffers:
+            in_ring = len(view) >= self.RING_THRESHOLD and \
+                self._outbox is not None and self._outbox.write(view)
+            entries.append(_BUFFER.pack(in_ring, len(view)))
+            if not in_ring:
+                inline.append(view)
+        frame = [_FRAME.pack(len(payload), len(buffers))] + entries
+        return self.conn.sendall_many(frame + [payload] + inline, timeout)
+
+    def get(self, timeout=None):
+        """Event: receive the next object sent from the other endpoint.
+        Raises EOFError if the other end has been closed.
+        """
+        return with_timeout(self._get(), timeout)
+
+    def _get(self):
+        head = bytearray(_FRAME.size)
+        if (yield self.conn.readexactly_into(head)) < len(head):
+            raise EOFError()
+        size, count = _FRAME.unpack(head)
+
+        # The buffer entries and the pickle.
+        body = bytearray(count * _BUFFER.size + size)
+        if (yield self.conn.readexactly_into(body)) < len(body):
+            raise EOFError()
+
+        buffers = []
+        for i in range(count):
+            in_ring, length = _BUFFER.unpack_from(body, i * _BUFFER.size)
+            if in_ring:
+                buffers.append(self._inbox.read(length))
+            else:
+                buf = bytearray(length)
+                if (yield self.conn.readexactly_into(buf)) < length:
+                    raise EOFError()
+                buffers.append(buf)
+
+        payload = memoryview(body)[count * _BUFFER.size:]
+        if _PICKLE_OOB:
+            yield ReturnEvent(pickle.loads(payload, buffers=buffers))
+        else:
+            yield ReturnEvent(pickle.loads(bytes(payload)))
+
+    def close(self):
+        """Close this end of the channel. (Not an event.)"""
+        self.conn.close()
+
+def channel(ring_size=0):
+    """Create a pair of connected Endpoints (over a socket pair) for
+    sending objects between threads or, when the endpoints are handed
+    to processes forked afterwards, between processes. If ring_size is
+    given, each direction also gets a shared memory ring of that many
+    bytes for large buffers (this needs Python 3.8). Not an event.
+    """
+    a, b = socket.socketpair()
+    ring_ab = ring_ba = None
+    if ring_size:
+        ring_ab = _Ring(ring_size)
+        ring_ba = _Ring(ring_size)
+    return Endpoint(a, ring_ab, ring_ba), Endpoint(b, ring_ba, ring_ab)
+
+
+# Running on top of an asyncio event loop, so that Bluelet threads and
+# asyncio code can share a process (and asyncio's faster loops, such as
+# uvloop). Threads started with to_asyncio() on the same loop share a
+# scheduler that lives as long as they do.
+
+class _AsyncioBackend(SelectBackend):
+    """Watches descriptors with an asyncio event loop's add_reader() and
+    add_writer(). It never blocks: poll() just returns the descriptors
+    that the loop has found ready since the last call, and the callback
+    is called whenever there are some. EXCEPT conditions are not
+    supported.
+    """
+    name = 'asyncio'
+
+    def __init__(self, loop, callback):
+        SelectBackend.__init__(self)
+        self.loop = loop
+        self.callback = callback
+        self.ready = {}
+
+    def register(self, fd, mask):
+        self._watch(fd, 0, mask)
+        self.registered[fd] = mask
+
+    def modify(self, fd, mask):
+        self._watch(fd, self.registered[fd], mask)
+        self.registered[fd] = mask
+
+    def unregister(self, fd):
+        self._watch(fd, self.registered.pop(fd), 0)
+        self.ready.pop(fd, None)
+
+    def _watch(self, fd, old, new):
+        loop = self.loop
+        for bit, add, remove in ((READ, loop.add_reader, loop.remove_reader),
+                                 (WRITE, loop.add_writer, loop.remove_writer)):
+            if new & bit and not old & bit:
+                add(fd, self._ready, fd, bit)
+            elif old & bit and not new & bit:
+                remove(fd)
+
+    def _ready(self, fd, bit):
+        self.ready[fd] = self.ready.get(fd, 0) | bit
+        self.callback()
+
+    def poll(self, timeout):
+        ready = list(self.ready.items())
+        self.ready.clear()
+        return ready
+
+    def close(self):
+        for fd in list(self.registered):
+            self.unregister(fd)
+
+class _AsyncioScheduler(_Scheduler):
+    """A scheduler driven by an asyncio event loop instead of its own
+    main loop. Each pass through the threads runs as a loop callback,
+    scheduled as soon as threads are ready or I/O arrives, or with
+    call_at() for the next timer. It has no root thread: an exception
+    that no thread joins is passed to the loop's exception handler.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.handle = None  # The scheduled pass, if any.
+        self.soon = False  # Whether it is scheduled to run right away.
+        self.stepping = False
+        _Scheduler.__init__(self, None, _AsyncioBackend(loop, self.wakeup))
+
+    def wakeup(self):
+        """Schedule a pass through the threads right away."""
+        if not self.soon:
+            if self.handle:
+                self.handle.cancel()
+            self.handle = self.loop.call_soon(self.tick)
+            self.soon = True
+
+    def resume(self, coro, value=None, is_exc=False):
+        _Scheduler.resume(self, coro, value, is_exc)
+        if not self.stepping:
+            # Resumed from outside (by asyncio code, say).
+            self.wakeup()
+
+    def tick(self):
+        """Make a pass through the threads and schedule the next one."""
+        self.handle = None
+        self.soon = False
+        self.stepping = True
+        try:
+            running = self.step(False)
+        finally:
+            self.stepping = False
+        if not running:
+            self.stop()
+            return
+
+        # Watch the descriptors that threads started waiting on.
+        self.registry.flush()
+        if self.ready:
+            self.wakeup()
+        else:
+            timeout = self.timers.timeout()
+            if timeout is not None:
+                self.handle = self.loop.call_at(self.loop.time() + timeout,
+                                                self.tick)
+
+    def stop(self):
+        """Shut the scheduler down, killing any remaining threads."""
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+        if _asyncio_schedulers.get(self.loop) is self:
+            del _asyncio_schedulers[self.loop]
+        self.close()
+
+    def unhandled(self, te):
+        exc = te.exc_info[1]
+        if not isinstance(exc, Exception):
+            # KeyboardInterrupt or SystemExit: stop the loop too.
+            self.stop()
+            te.reraise()
+        self.loop.call_exception_handler({
+            'message': 'Unhandled exception in Bluelet thread',
+            'exception': exc,
+        })
+
+    def interrupt(self, exc_info):
+        # There's no root thread to raise it in. Let the loop deal with
+        # it.
+        self.stop()
+        _reraise(*exc_info)
+
+    def _on_future(self, coro, event):
+        import asyncio
+        future = event.future
+        if future.done() or not asyncio.isfuture(future) or \
+                future.get_loop() is not self.loop:
+            return _Scheduler._on_future(self, coro, event)
+        # The future's callbacks run on our loop, so no waker is needed.
+        future.add_done_callback(
+            lambda f: self._future_done(coro, event)
+        )
+
+# The scheduler running on each asyncio event loop.
+_asyncio_schedulers = {}
+
+def from_asyncio(awaitable, loop=None):
+    """Event: wait for an asyncio future, or run an asyncio coroutine
+    as a task, and return the result (or raise the exception). In
+    threads started with `to_asyncio`, this uses the loop they run on.
+    Elsewhere (under `run`, say), pass the `loop`, which must be
+    running in another OS thread.
+    """
+    import asyncio
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if loop is None:
+        if running is None:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise RuntimeError('no asyncio event loop is running here; '
+                               'pass the loop to wait on')
+        loop = running
+    if loop is running:
+        return FutureEvent(asyncio.ensure_future(awaitable, loop=loop))
+
+    # The loop belongs to another OS thread, so start the task there
+    # and pass its outcome back through a thread-safe future.
+    import concurrent.futures
+    future = concurrent.futures.Future()
+
+    def settle(task):
+        if future.cancelled():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        try:
+            task = asyncio.ensure_future(awaitable, loop=loop)
+        except BaseException as exc:
+            future.set_exception(exc)
+        else:
+            task.add_done_callback(settle)
+
+    loop.call_soon_threadsafe(start)
+    return FutureEvent(future)
+
+def to_asyncio(coro, loop=None):
+    """Run a coroutine as a Bluelet thread on an asyncio event loop (by
+    default, the current one) and return an asyncio future for its
+    result, so asyncio code can wait for it:
+
+        result = await bluelet.to_asyncio(coro())
+
+    Cancelling the future kills the thread. Not an event; call this
+    from the loop's OS thread.
+    """
+    import asyncio
+    if not isinstance(coro, _COROUTINE_TYPES):
+        raise ValueError('%s is not a coroutine' % str(coro))
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    scheduler = _asyncio_schedulers.get(loop)
+    if scheduler is None:
+        scheduler = _asyncio_schedulers[loop] = _AsyncioScheduler(loop)
+
+    future = loop.create_future()
+    thread = _settle(coro, future)
+    scheduler.add_thread(thread)
+
+    def cancelled(f):
+        if f.cancelled() and thread in scheduler.threads:
+            scheduler.kill_thread(thread)
+            scheduler.wakeup()
+    future.add_done_callback(cancelled)
+    return future
+
+def _settle(coro, future):
+    # Runs a coroutine for to_asyncio(), passing its outcome on to the
+    # future.
+    try:
+        value = yield coro
+    except Exception:
+        if not future.done():
+            future.set_exception(sys.exc_info()[1])
+    else:
+        if not future.done():
+            future.set_result(value)
+    finally:
+        if not future.done():
+            # The thread was killed.
+            future.cancel()
 
 # Convenience function for running socket servers.
 
@@ -614,18 +3278,116 @@ def server(host, port, func):
     parameter, a Connection object. The coroutine is invoked for every
     incoming connection on the listening socket.
     """
+    return _serve(Listener(host, port), func)
+
+def _serve(listener, func):
     def handler(conn):
         try:
             yield func(conn)
         finally:
             conn.close()
 
-    listener = Listener(host, port)
     try:
         while True:
-            conn = yield listener.accept()
-            yield spawn(handler(conn))
+            conns = yield listener.accept_many()
+            yield _SpawnManyEvent([handler(conn) for conn in conns])
     except KeyboardInterrupt:
         pass
     finally:
         listener.close()
+
+def serve_multiprocess(host, port, func, workers=None, backend=None):
+    """Run a network server like `server`, but in several forked worker
+    processes, each with its own scheduler, to make use of more than
+    one CPU. workers defaults to the number of CPUs. This function
+    blocks, supervising the workers: one that exits is replaced, and
+    SIGTERM (or KeyboardInterrupt) is passed on to the workers and
+    returns once they have all exited. Unix only.
+
+    Where SO_REUSEPORT is available, each worker has its own listening
+    socket and the kernel balances connections among them; otherwise
+    the workers share one listening socket.
+    """
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+
+    shared = None
+    if not _have_reuseport():
+        shared = Listener(host, port)
+
+    children = {}  # Worker PIDs and their start times.
+    stopping = []  # Avoiding nonlocal.
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            # In the worker. SIGTERM shuts the server down gracefully.
+            signal.signal(signal.SIGTERM, _worker_sigterm)
+            status = 1
+            try:
+                listener = shared or Listener(host, port, reuse_port=True)
+                run(_serve(listener, func), backend)
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        children[pid] = _now()
+        if stopping:
+            _kill(pid, signal.SIGTERM)
+
+    def stop(signum=None, frame=None):
+        stopping.append(True)
+        for pid in list(children):
+            _kill(pid, signal.SIGTERM)
+
+    old_handler = signal.signal(signal.SIGTERM, stop)
+    try:
+        for _ in range(workers):
+            start_worker()
+        while children:
+            try:
+                pid, _ = os.wait()
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            except KeyboardInterrupt:
+                stop()
+                continue
+            started = children.pop(pid, None)
+            if started is None or stopping:
+                continue
+            if _now() - started < 1.0:
+                # Don't restart a failing worker in a tight loop.
+                time.sleep(1.0)
+            start_worker()
+    finally:
+        signal.signal(signal.SIGTERM, old_handler)
+        if shared:
+            shared.close()
+
+def _have_reuseport():
+    """Check whether the platform supports SO_REUSEPORT."""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return False
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def _worker_sigterm(signum, frame):
+    # Stop the server as for Ctrl-C, just once.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt()
+
+def _kill(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except OSError:
+        pass  # Already gone.
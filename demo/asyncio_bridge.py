@@ -0,0 +1,50 @@
+"""Runs a Bluelet echo server on top of an asyncio event loop and talks
+to it with asyncio streams. The Bluelet side also waits for an asyncio
+coroutine. Needs Python 3.7 or later.
+"""
+from __future__ import print_function
+import sys
+import asyncio
+sys.path.insert(0, '..')
+import bluelet
+
+def echoer(conn):
+    # A plain Bluelet coroutine, unaware that asyncio is driving it.
+    while True:
+        data = yield conn.recv(1024)
+        if not data:
+            break
+        # Wait for something from the asyncio world.
+        reply = yield bluelet.from_asyncio(shout(data))
+        yield conn.sendall(reply)
+
+async def shout(data):
+    await asyncio.sleep(0.01)
+    return data.upper()
+
+def server(listener):
+    while True:
+        conn = yield listener.accept()
+        yield bluelet.spawn(echoer(conn))
+
+async def client(port, message):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(message)
+    reply = await reader.read(1024)
+    writer.close()
+    return reply
+
+async def main():
+    listener = bluelet.Listener('127.0.0.1', 0)
+    port = listener.sock.getsockname()[1]
+    serving = bluelet.to_asyncio(server(listener))
+    replies = await asyncio.gather(*[
+        client(port, ('hello %i' % i).encode()) for i in range(5)
+    ])
+    for reply in replies:
+        print(reply.decode())
+    serving.cancel()
+    listener.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+"""Measures the cost of basic scheduler operations as the number of
+parked (blocked) threads grows. With a ready queue, resuming or
+spawning a thread should take the same time no matter how many other
+threads are waiting. Calling a sub-coroutine happens within the thread,
+but still goes through the scheduler, so it is compared with the same
+chain of calls made with plain `yield from`. Needs Python 3.
+"""
+from __future__ import print_function
+import sys
+import time
+import socket
+sys.path.insert(0, '..')
+import bluelet
+
+OPS = 10000
+PARKED = (0, 1000, 10000)
+DEPTH = 10
+
+def gate(conn):
+    # Blocks until the benchmark is over.
+    yield conn.recv(1)
+
+def parked(gate_thread):
+    yield bluelet.join(gate_thread)
+
+def child():
+    yield bluelet.null()
+
+def nested(depth):
+    # A chain of sub-coroutine calls, passing a value back up.
+    if not depth:
+        return 0
+    value = yield nested(depth - 1)
+    return value + 1
+
+def plain_nested(depth):
+    # The same chain with yield from, for comparison.
+    if not depth:
+        return 0
+    value = yield from plain_nested(depth - 1)
+    return value + 1
+
+def bench_plain():
+    """Return the time, in microseconds, for each call in a chain of
+    generators calling each other with yield from.
+    """
+    start = time.time()
+    for i in range(OPS):
+        for _ in plain_nested(DEPTH):
+            pass
+    return (time.time() - start) / (OPS * DEPTH) * 1e6
+
+def bench(nparked):
+    """Return the per-operation times, in microseconds, for yielding,
+    for spawning and joining a thread, and for each call in a chain of
+    sub-coroutine calls, while `nparked` other threads are blocked.
+    """
+    timings = {}
+    sock, other = socket.socketpair()
+
+    def main():
+        gate_thread = gate(bluelet.Connection(sock, None))
+        yield bluelet.spawn(gate_thread)
+        for i in range(nparked):
+            yield bluelet.spawn(parked(gate_thread))
+        yield bluelet.null()
+
+        start = time.time()
+        for i in range(OPS):
+            yield bluelet.null()
+        timings['resume'] = (time.time() - start) / OPS * 1e6
+
+        start = time.time()
+        for i in range(OPS):
+            c = child()
+            yield bluelet.spawn(c)
+            yield bluelet.join(c)
+        timings['spawn+join'] = (time.time() - start) / OPS * 1e6
+
+        start = time.time()
+        for i in range(OPS):
+            yield nested(DEPTH)
+        timings['call'] = (time.time() - start) / (OPS * DEPTH) * 1e6
+
+        other.send(b'x')
+
+    bluelet.run(main())
+    sock.close()
+    other.close()
+    return timings
+
+if __name__ == '__main__':
+    for nparked in PARKED:
+        timings = bench(nparked)
+        print('%6i parked: %s' % (nparked, ', '.join(
+            '%s %.1f us' % (k, v) for k, v in sorted(timings.items())
+        )))
+    print('yield from call: %.2f us' % bench_plain())
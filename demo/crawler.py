@@ -32,12 +32,15 @@ USERNAMES = ('samps', 'b33ts', 'twitter', 'twitterapi', 'Support')
 
 class AsyncHTTPClient(object):
     """A basic Bluelet-based asynchronous HTTP client. Only supports
-    very simple GET queries.
+    very simple GET queries. If a bluelet.ConnectionPool is given,
+    connections are kept alive and reused for later requests to the
+    same host.
     """
-    def __init__(self, host, port, path):
+    def __init__(self, host, port, path, pool=None):
         self.host = host
         self.port = port
         self.path = path
+        self.pool = pool
 
     def headers(self):
         """Returns the HTTP headers for this request."""
@@ -46,60 +49,92 @@ class AsyncHTTPClient(object):
             "Host: %s" % self.host,
             "User-Agent: bluelet-example",
         ]
+        if not self.pool:
+            heads.append("Connection: close")
         return "\r\n".join(heads).encode('utf8') + b"\r\n\r\n"
 
 
     # Convenience methods.
 
     @classmethod
-    def from_url(cls, url):
+    def from_url(cls, url, pool=None):
         """Construct a request for the specified URL."""
         res = urlparse(url)
         path = res.path
         if res.query:
             path += '?' + res.query
-        return cls(res.hostname, res.port or 80, path)
+        return cls(res.hostname, res.port or 80, path, pool)
 
     @classmethod
-    def fetch(cls, url):
+    def fetch(cls, url, pool=None):
         """Fetch content from an HTTP URL. This is a coroutine suitable
         for yielding to bluelet.
         """
-        client = cls.from_url(url)
+        client = cls.from_url(url, pool)
         yield client._connect()
-        yield client._request()
-        status, headers, body = yield client._read()
-        yield bluelet.end(body)
-    
+        try:
+            yield client._request()
+            status, headers, body = yield client._read()
+        except:
+            client._done(False)
+            raise
+        client._done(headers.get('connection', '').lower() != 'close')
+        yield bluelet.end(body.decode('utf8'))
+
 
     # Internal coroutines.
 
     def _connect(self):
-        self.conn = yield bluelet.connect(self.host, self.port)
+        if self.pool:
+            self.conn = yield self.pool.acquire(self.host, self.port)
+        else:
+            self.conn = yield bluelet.connect(self.host, self.port)
 
     def _request(self):
         yield self.conn.sendall(self.headers())
 
     def _read(self):
-        buf = []
+        # Status line and headers.
+        status = (yield self.conn.readline()).decode('latin1')
+        version, code, message = status.rstrip().split(' ', 2)
+        headervals = {}
         while True:
-            data = yield self.conn.recv(4096)
-            if not data:
+            line = (yield self.conn.readline()).decode('latin1').rstrip()
+            if not line:
                 break
-            buf.append(data)
-        response = ''.join(buf)
-
-        # Parse response.
-        headers, body = response.split("\r\n\r\n", 1)
-        headers = headers.split("\r\n")
-        status = headers.pop(0)
-        version, code, message = status.split(' ', 2)
-        headervals = {}
-        for header in headers:
-            key, value = header.split(": ")
-            headervals[key] = value
-
-        yield bluelet.end((int(code), headers, body))
+            key, value = line.split(":", 1)
+            headervals[key.lower()] = value.strip()
+
+        # Body: delimited by its length, chunked, or running to the end
+        # of the connection.
+        if 'content-length' in headervals:
+            body = bytearray(int(headervals['content-length']))
+            yield self.conn.readexactly_into(body)
+        elif headervals.get('transfer-encoding') == 'chunked':
+            body = bytearray()
+            while True:
+                size = int((yield self.conn.readline()).split(b';')[0], 16)
+                chunk = bytearray(size + 2)  # Including the CRLF.
+                yield self.conn.readexactly_into(chunk)
+                if not size:
+                    break
+                body += chunk[:-2]
+        else:
+            body = bytearray()
+            while True:
+                data = yield self.conn.recv(4096)
+                if not data:
+                    break
+                body += data
+            headervals['connection'] = 'close'
+
+        yield bluelet.end((int(code), headervals, bytes(body)))
+
+    def _done(self, reuse):
+        if self.pool:
+            self.pool.release(self.conn, reuse)
+        else:
+            self.conn.close()
 
 
 # Various ways of writing the crawler.
@@ -109,14 +144,27 @@ def run_bluelet():
     # one thread is actually running at a time.
     tweets = {}
 
+    # Requests to the same host share a few kept-alive connections, and
+    # at most a few fetches are under way at once.
+    pool = bluelet.ConnectionPool(max_per_host=2)
+    limit = bluelet.Semaphore(3)
+
     def fetch(username):
         url = URL % username
-        data = yield AsyncHTTPClient.fetch(url)
-        tweets[username] = json.loads(data)[0]['text']
+        with (yield limit.acquire()):
+            data = yield AsyncHTTPClient.fetch(url, pool)
+        # Decode in another process so that parsing a large response
+        # doesn't hold up the other requests.
+        timeline = yield bluelet.to_process(json.loads, data)
+        tweets[username] = timeline[0]['text']
 
     def crawl():
-        for username in USERNAMES:
-            yield bluelet.spawn(fetch(username))
+        fetches = [fetch(username) for username in USERNAMES]
+        for child in fetches:
+            yield bluelet.spawn(child)
+        for child in fetches:
+            yield bluelet.join(child)
+        pool.close()
 
     bluelet.run(crawl())
     return tweets
@@ -33,7 +33,9 @@ def mime_type(filename):
         return 'text/plain'
 
 def respond(method, path, headers):
-    """Generate an HTTP response for a parsed request."""
+    """Generate an HTTP response for a parsed request. The content is
+    either a string or an open file to be sent.
+    """
     # Remove query string, if any.
     if b'?' in path:
         path, query = path.split(b'?', 1)
@@ -63,8 +65,8 @@ def respond(method, path, headers):
 
     elif os.path.exists(filename):
         # Send file contents.
-        with open(filename) as f:
-            return '200 OK', {'Content-Type': mime_type(filename)}, f.read()
+        return '200 OK', {'Content-Type': mime_type(filename)}, \
+               open(filename, 'rb')
 
     else:
         # Not found.
@@ -91,17 +93,35 @@ def webrequest(conn):
     # Parse and log the request and get the response values.
     method, path, headers = parse_request(request)
     print('%s %s' % (method, path))
-    status, headers, content = respond(method, path, headers)
+    # Looking at the file system can block, so do it on a worker
+    # thread while other requests are served.
+    status, headers, content = \
+        yield bluelet.to_thread(respond, method, path, headers)
 
-    # Send response.
-    yield conn.sendall(("HTTP/1.1 %s\r\n" % status).encode('utf8'))
+    # Send response. The status line, headers, and (for generated
+    # pages) body all go out together in one vectored write.
+    parts = [("HTTP/1.1 %s\r\n" % status).encode('utf8')]
     for key, value in headers.items():
-        yield conn.sendall(("%s: %s\r\n" % (key, value)).encode('utf8'))
-    yield conn.sendall(b"\r\n")
-    yield conn.sendall(content)
+        parts.append(("%s: %s\r\n" % (key, value)).encode('utf8'))
+    parts.append(b"\r\n")
+    if hasattr(content, 'read'):
+        # Copy the file straight from the kernel to the socket.
+        try:
+            yield conn.sendall_many(parts)
+            yield conn.sendfile(content)
+        finally:
+            content.close()
+    else:
+        parts.append(content.encode('utf8'))
+        yield conn.sendall_many(parts)
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         ROOT = os.path.expanduser(sys.argv[1])
     print('http://127.0.0.1:8000/')
-    bluelet.run(bluelet.server('', 8000, webrequest))
+    if len(sys.argv) > 2:
+        # Serve from several processes: httpd.py ROOT WORKERS
+        bluelet.serve_multiprocess('', 8000, webrequest,
+                                   workers=int(sys.argv[2]))
+    else:
+        bluelet.run(bluelet.server('', 8000, webrequest))